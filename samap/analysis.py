@@ -205,7 +205,7 @@ class FunctionalEnrichment(object):
         # link up SAM memories.
         for sid in sm.ids:
             sm.sams[sid] = SAMS[sid]
-            gc.collect()
+        gc.collect()
             
         for k in DFS.keys():
             DFS[k].index = k+'_'+DFS[k].index
@@ -1476,24 +1476,27 @@ def _compute_csim(samap, key, X=None, prepend=True, n_top = 0):
     xi = xi[filt]
     yi = yi[filt]
 
-    px,py = xi,cl[yi]
-    p = px.astype('str').astype('object')+';'+py.astype('object')
-
-    A = pd.DataFrame(data=np.vstack((p, di)).T, columns=["x", "y"])
-    valdict = df_to_dict(A, key_key="x", val_key="y")   
-    cell_scores = [valdict[k].sum() for k in valdict.keys()]
     ixer = pd.Series(data=np.arange(clu.size),index=clu)
-    if len(valdict.keys())>0:
-        xc,yc = substr(list(valdict.keys()),';')
-        xc = xc.astype('int')
-        yc=ixer[yc].values
-        cell_cluster_scores = sp.sparse.coo_matrix((cell_scores,(xc,yc)),shape=(X.shape[0],clu.size)).A
-
-        for i, c in enumerate(clu):
-            if n_top > 0:
+    cl_codes = ixer[cl].values
+    if di.size>0:
+        # sum edge weights from each cell into its neighbors' clusters;
+        # COO construction sums duplicate (cell, cluster) entries.
+        cell_cluster_scores = sp.sparse.coo_matrix(
+            (di, (xi, cl_codes[yi])), shape=(X.shape[0], clu.size)
+        ).A
+
+        if n_top > 0:
+            for i, c in enumerate(clu):
                 CSIM[i, :] = np.sort(cell_cluster_scores[cl==c],axis=0)[-n_top:].mean(0)
-            else:
-                CSIM[i, :] = cell_cluster_scores[cl==c].mean(0)
+        else:
+            # cluster-wise mean via a one-hot indicator SpMM instead of
+            # slicing the score matrix once per cluster.
+            Z = sp.sparse.csr_matrix(
+                (np.ones(cl_codes.size), (np.arange(cl_codes.size), cl_codes)),
+                shape=(cl_codes.size, clu.size),
+            )
+            counts = np.bincount(cl_codes, minlength=clu.size).astype("float")
+            CSIM = Z.T.dot(cell_cluster_scores) / counts[:, None]
 
         CSIM = np.stack((CSIM,CSIM.T),axis=2).max(2)
         CSIMth = CSIM / samap.adata.uns['mapping_K']
@@ -1541,15 +1544,16 @@ def get_mapping_scores(sm, keys, n_top = 0):
     CSIMth, clu = _compute_csim(samap, l, n_top = n_top, prepend = False)
 
     A = pd.DataFrame(data=CSIMth, index=clu, columns=clu)
-    i = np.argsort(-A.values.max(0).flatten())
-    H = []
-    C = []
-    for I in range(A.shape[1]):
-        x = A.iloc[:, i[I]].sort_values(ascending=False)
-        H.append(np.vstack((x.index, x.values)).T)
-        C.append(A.columns[i[I]])
-        C.append(A.columns[i[I]])
-    H = np.hstack(H)
+    vals = A.values
+    i = np.argsort(-vals.max(0).flatten())
+    # sort all columns at once rather than one pandas sort_values per column
+    order = np.argsort(-vals[:, i], axis=0)
+    srt = np.take_along_axis(vals[:, i], order, axis=0)
+    names = q(A.index)[order]
+    H = np.empty((vals.shape[0], 2 * i.size), dtype="object")
+    H[:, ::2] = names
+    H[:, 1::2] = srt
+    C = list(np.repeat(q(A.columns)[i], 2))
     D = pd.DataFrame(data=H, columns=[C, ["Cluster","Alignment score"]*(H.shape[1]//2)])
     return D, A
 
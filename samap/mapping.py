@@ -2,7 +2,7 @@ from scipy.stats import binned_statistic
 import hnswlib
 import sklearn.utils.sparsefuncs as sf
 import typing
-from numba import njit, prange
+from numba import njit, prange, get_num_threads
 import os
 from os import path
 import gc
@@ -12,7 +12,7 @@ from sklearn.preprocessing import StandardScaler
 
 from . import q, ut, pd, sp, np, warnings, sc
 from .analysis import _compute_csim
-from .utils import prepend_var_prefix, to_vn, substr, sparse_knn, df_to_dict
+from .utils import prepend_var_prefix, to_vn, substr, sparse_knn, df_to_dict, _csr_topk_kernel
 
 from numba.core.errors import NumbaPerformanceWarning, NumbaWarning
 
@@ -20,6 +20,39 @@ warnings.filterwarnings("ignore", category=NumbaPerformanceWarning)
 warnings.filterwarnings("ignore", category=NumbaWarning)
 
 
+def _load_and_preprocess_sam(path, limit_threads=None):
+    """Load an '.h5ad' file and run the standard SAMap preprocessing on it.
+
+    `limit_threads` caps the BLAS thread count so concurrent workers do not
+    oversubscribe the machine."""
+    if limit_threads:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            pass
+        else:
+            with threadpool_limits(limits=limit_threads):
+                return _load_and_preprocess_sam(path)
+    sam = SAM()
+    sam.load_data(path)
+    sam.preprocess_data(
+        sum_norm="cell_median",
+        norm="log",
+        thresh_low=0.0,
+        thresh_high=0.96,
+        min_expression=1,
+    )
+    sam.run(
+        preprocessing="StandardScaler",
+        npcs=100,
+        weight_PCs=False,
+        k=20,
+        n_genes=3000,
+        weight_mode='rms'
+    )
+    return sam
+
+
 class SAMAP(object):
     def __init__(
         self,
@@ -99,43 +132,48 @@ class SAMAP(object):
                 resolutions[sid] = 3
 
 
+        # per-species preprocessing runs are independent; when several species
+        # come in as file paths, process them in parallel worker processes,
+        # splitting the BLAS threads between workers to avoid oversubscription.
+        processed_paths = {}
+        file_sids = [sid for sid in ids if isinstance(sams[sid], str)]
+        if len(file_sids) > 1:
+            import concurrent.futures
+
+            nthr = max(1, os.cpu_count() // len(file_sids))
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=len(file_sids)
+            ) as ex:
+                futs = {}
+                for sid in file_sids:
+                    print("Processing data {} from:\n{}".format(sid, sams[sid]))
+                    futs[sid] = ex.submit(_load_and_preprocess_sam, sams[sid], nthr)
+                for sid in file_sids:
+                    processed_paths[sid] = sams[sid]
+                    sams[sid] = futs[sid].result()
+
         for sid in ids:
             data = sams[sid]
             key = keys[sid]
             res = resolutions[sid]
-            
+
             if isinstance(data, str):
                 print("Processing data {} from:\n{}".format(sid,data))
-                sam = SAM()
-                sam.load_data(data)
-                sam.preprocess_data(
-                    sum_norm="cell_median",
-                    norm="log",
-                    thresh_low=0.0,
-                    thresh_high=0.96,
-                    min_expression=1,
-                )
-                sam.run(
-                    preprocessing="StandardScaler",
-                    npcs=100,
-                    weight_PCs=False,
-                    k=20,
-                    n_genes=3000,
-                    weight_mode='rms'
-                )
+                sam = _load_and_preprocess_sam(data)
             else:
-                sam = data                
-            
+                sam = data
+
             if key == "leiden_clusters":
                 sam.leiden_clustering(res=res)
-                
+
             if "PCs_SAMap" not in sam.adata.varm.keys():
-                prepare_SAMap_loadings(sam)  
+                prepare_SAMap_loadings(sam)
 
-            if save_processed and isinstance(data,str):
-                sam.save_anndata(data.split('.h5ad')[0]+'_pr.h5ad')
+            if save_processed and (isinstance(data,str) or sid in processed_paths):
+                path = data if isinstance(data, str) else processed_paths[sid]
+                sam.save_anndata(path.split('.h5ad')[0]+'_pr.h5ad')
 
-            sams[sid] = sam             
+            sams[sid] = sam
 
         if gnnm is None:
             gnnm, gns, gns_dict = _calculate_blast_graph(
@@ -156,22 +194,21 @@ class SAMAP(object):
             prepend_var_prefix(sams[sid], sid)
             ge = q(sams[sid].adata.var_names)
             gn = gns_dict[sid]
-            gns_list.append(gn[np.in1d(gn, ge)])
+            gns_list.append(gn[_isin_hash(gn, ge)])
             ges_list.append(ge)
         
-        f = np.in1d(gns, np.concatenate(gns_list))
+        f = _isin_hash(gns, np.concatenate(gns_list))
         gns = gns[f]
         gnnm = gnnm[f][:, f]
-        A = pd.DataFrame(data=np.arange(gns.size)[None, :], columns=gns)
         ges = np.concatenate(ges_list)
-        ges = ges[np.in1d(ges, gns)]
-        ix = A[ges].values.flatten()
+        ges = ges[_isin_hash(ges, gns)]
+        ix = _positions(gns, ges)
         gnnm = gnnm[ix][:, ix]
         gns = ges
         
         gns_dict = {}
         for i,sid in enumerate(ids):
-            gns_dict[sid] = ges[np.in1d(ges,gns_list[i])]
+            gns_dict[sid] = ges[_isin_hash(ges, gns_list[i])]
         
             print(
                 "{} `{}` gene symbols match between the datasets and the BLAST graph.".format(
@@ -181,7 +218,12 @@ class SAMAP(object):
 
         for sid in sams:
             if not sp.sparse.issparse(sams[sid].adata.X):
-                sams[sid].adata.X = sp.sparse.csr_matrix(sams[sid].adata.X)
+                # dense inputs are typically float64 with many stored
+                # zeros; float32 is plenty for expression values and
+                # halves the memory every downstream SpMV touches.
+                X = sp.sparse.csr_matrix(sams[sid].adata.X.astype(np.float32))
+                X.eliminate_zeros()
+                sams[sid].adata.X = X
 
         smap = _Samap_Iter(sams, gnnm, gns_dict, keys=keys)
         self.sams = sams
@@ -203,7 +245,10 @@ class SAMAP(object):
         hom_edge_mode: typing.Optional[str] = "pearson",
         scale_edges_by_corr: typing.Optional[bool] = True,
         neigh_from_keys: typing.Optional[dict] = None,
-        pairwise: typing.Optional[bool] = True
+        pairwise: typing.Optional[bool] = True,
+        track_history: typing.Optional[bool] = False,
+        tol: typing.Optional[float] = None,
+        backend: typing.Optional[str] = "hnswlib"
     ):
         """Runs the SAMap algorithm.
 
@@ -270,7 +315,23 @@ class SAMAP(object):
             between different species. Set `pairwise=True` when you'd like to remove the effects of evolutionary
             distance. This is particularly useful when using multiple reference species to annotate an unlabeled
             dataset.
-            
+
+        track_history : bool, optional, default False
+            If True, keep the homology graphs and stitched manifolds from every
+            iteration in `self.ITER_DATA`. By default only the most recent
+            iteration is retained to keep memory usage flat.
+
+        tol : float, optional, default None
+            If set, stop iterating early once the maximum change in the
+            alignment scores between consecutive iterations drops below
+            `tol`. By default all `NUMITERS` iterations are run.
+
+        backend : str, optional, default "hnswlib"
+            Nearest-neighbor backend for the cross-species kNN search.
+            "hnswlib" uses approximate HNSW indices; "faiss" uses exact
+            flat FAISS indices (on GPU when one is available) and requires
+            package `faiss` to be installed.
+
         Returns
         -------
         samap - Species-merged SAM object
@@ -295,6 +356,7 @@ class SAMAP(object):
 
         start_time = time.time()
 
+        smap.track_history = track_history
         smap.run(
             NUMITERS=NUMITERS,
             NHS=NHS,
@@ -305,7 +367,9 @@ class SAMAP(object):
             corr_mode=hom_edge_mode,
             scale_edges_by_corr = scale_edges_by_corr,
             neigh_from_keys=neigh_from_keys,
-            pairwise=pairwise
+            pairwise=pairwise,
+            tol=tol,
+            backend=backend
         )
         samap = smap.final_sam
         self.samap = samap
@@ -313,25 +377,26 @@ class SAMAP(object):
 
         if umap:
             print("Running UMAP on the stitched manifolds.")
-            sc.tl.umap(self.samap.adata,min_dist=0.1,init_pos='random',maxiter = 500 if self.samap.adata.shape[0] <= 10000 else 200)
+            # spectral initialization from the stitched graph converges in far
+            # fewer epochs than a random start of the layout optimization.
+            sc.tl.umap(self.samap.adata,min_dist=0.1,init_pos='spectral',maxiter = 500 if self.samap.adata.shape[0] <= 10000 else 200)
         
         
-        ix = pd.Series(data = np.arange(samap.adata.shape[1]),index = samap.adata.var_names)[gns].values
-        rixer = pd.Series(index =np.arange(gns.size), data = ix)
+        # positional gather: ix maps gns positions to adata columns, so the
+        # reindexing is plain ndarray fancy-indexing on the COO coordinates
+        # rather than a pandas alignment per index array.
+        ix = _positions(q(samap.adata.var_names), gns)
         
         try:
-            hom_graph = smap.GNNMS_corr[-1]
-            x,y = hom_graph.nonzero()
-            d = hom_graph.data
-            hom_graph = sp.sparse.coo_matrix((d,(rixer[x].values,rixer[y].values)),shape=(samap.adata.shape[1],)*2).tocsr()                    
+            hom_graph = smap.GNNMS_corr[-1].tocoo()
+            hom_graph = sp.sparse.coo_matrix((hom_graph.data,(ix[hom_graph.row],ix[hom_graph.col])),shape=(samap.adata.shape[1],)*2).tocsr()
             samap.adata.varp["homology_graph_reweighted"] = hom_graph
             self.gnnm_refined = hom_graph            
         except:
             pass
         
-        x,y = gnnm.nonzero()
-        d = gnnm.data
-        gnnm = sp.sparse.coo_matrix((d,(rixer[x].values,rixer[y].values)),shape=(samap.adata.shape[1],)*2).tocsr()                            
+        gco = gnnm.tocoo()
+        gnnm = sp.sparse.coo_matrix((gco.data,(ix[gco.row],ix[gco.col])),shape=(samap.adata.shape[1],)*2).tocsr()
         samap.adata.varp["homology_graph"] = gnnm
         samap.adata.uns["homology_gene_names_dict"] = gns_dict
         
@@ -341,7 +406,7 @@ class SAMAP(object):
         
         gns_dict = {}
         for sid in ids:
-            gns_dict[sid] = self.gns[np.in1d(self.gns,q(self.sams[sid].adata.var_names))]
+            gns_dict[sid] = self.gns[_isin_hash(self.gns, q(self.sams[sid].adata.var_names))]
         self.gns_dict = gns_dict
         
         if umap:
@@ -356,7 +421,7 @@ class SAMAP(object):
         print("Running UMAP on the stitched manifolds.")
         ids = self.ids
         sams = self.sams
-        sc.tl.umap(self.samap.adata,min_dist=0.1,init_pos='random', maxiter = 500 if self.samap.adata.shape[0] <= 10000 else 200)
+        sc.tl.umap(self.samap.adata,min_dist=0.1,init_pos='spectral', maxiter = 500 if self.samap.adata.shape[0] <= 10000 else 200)
         for sid in ids:
             sams[sid].adata.obsm['X_umap_samap'] = self.samap.adata[sams[sid].adata.obs_names].obsm['X_umap']               
 
@@ -414,7 +479,7 @@ class SAMAP(object):
 
 
         if len(list(gs.keys()))<len(list(self.sams.keys())):
-            samap = SAM(counts = self.samap.adata[np.in1d(self.samap.adata.obs['species'],list(gs.keys()))])
+            samap = SAM(counts = self.samap.adata[_isin_hash(q(self.samap.adata.obs['species']), set(gs.keys()))])
         else:
             samap=self.samap
                                 
@@ -426,11 +491,7 @@ class SAMAP(object):
         if COLORS is None:
             COLORS={}
             for sid in self.ids:
-                s = ''
-                for i in range(6):
-                    s+=hex(np.random.randint(16))[-1].upper()
-                s='#'+s                
-                COLORS[sid] = s
+                COLORS[sid] = "#{:06X}".format(np.random.randint(0, 0x1000000))
                 
         def hex_to_rgb(value):
             value = value.lstrip('#')
@@ -441,11 +502,12 @@ class SAMAP(object):
         
         
 
-        nnm = samap.adata.obsp['connectivities']
-        su = nnm.sum(1).A.flatten()[:,None]
+        nnm = samap.adata.obsp['connectivities'].tocsr()
+        su = nnm.sum(1).A1
         su[su==0]=1
-
-        nnm = nnm.multiply(1/su).tocsr()
+        # row normalization commutes with the SpMV, so it is applied to the
+        # imputed vector instead of copying the whole scaled CSR.
+        inv_su = 1/su
         AS={}
         for sid in gs.keys():
             g = gs[sid]
@@ -457,18 +519,22 @@ class SAMAP(object):
                 except KeyError:
                     raise KeyError(f'Gene not found in species {sid}')
             
-        davgs={}
-        for sid in gs.keys():
+        # one (K, n_cells) float32 buffer holds every species' imputed
+        # expression; the old flow vstacked the per-species arrays twice and
+        # normalized each in a separate pass.
+        sids = list(gs.keys())
+        species = q(samap.adata.obs['species'])
+        M = np.empty((len(sids), samap.adata.shape[0]), dtype=np.float32)
+        for i, sid in enumerate(sids):
             d = np.zeros(samap.adata.shape[0])
-            d[samap.adata.obs['species']==sid] = AS[sid]
-            davg = nnm.dot(d).flatten()
-            davg[davg<thr]=0
-            davgs[sid] = davg
-        davg = np.vstack(list(davgs.values())).min(0)
-        ma = np.vstack(list(davgs.values())).max()
-        for sid in gs.keys():
-            if davgs[sid].max()>0:
-                davgs[sid] = davgs[sid]/davgs[sid].max()
+            d[species==sid] = AS[sid]
+            M[i] = nnm.dot(d).flatten() * inv_su
+        M[M < thr] = 0
+        davg = M.min(0)
+        mx = M.max(1)
+        nz = mx > 0
+        M[nz] /= mx[nz][:, None]
+        davgs = {sid: M[i] for i, sid in enumerate(sids)}
         if davg.max()>0:
             davg = davg/davg.max()
         
@@ -490,6 +556,21 @@ class SAMAP(object):
         
         return ax    
     
+    def _resolve_gene(self, gene):
+        """Resolve a (possibly unprefixed) gene name to its row in the
+        homology graph via a lazily built name -> index map."""
+        idx = getattr(self, "_gns_idx", None)
+        if idx is None or len(idx) != self.gns.size:
+            idx = {g: i for i, g in enumerate(self.gns)}
+            self._gns_idx = idx
+        if gene in idx:
+            return gene, idx[gene]
+        for sid in self.ids:
+            qgene = sid + '_' + gene
+            if qgene in idx:
+                return qgene, idx[qgene]
+        raise ValueError(f"Query gene {gene} not found in dataset.")
+
     def query_gene_pairs(self,gene):
         """ Get BLAST and correlation scores of all genes connected
         to the query gene.
@@ -502,28 +583,14 @@ class SAMAP(object):
         gene.
         """ 
 
-        ids = self.ids
-        qgene = None
-        if (gene in self.gns):
-            qgene = gene
-        else:
-            for sid in ids:
-                if sid+'_'+gene in self.gns:
-                    qgene = sid+'_'+gene
-                    break
-        if qgene is None:
-            raise ValueError(f"Query gene {gene} not found in dataset.")
+        qgene, i = self._resolve_gene(gene)
 
-        a = self.gnnm[self.gns==qgene]
-        b = self.gnnm_refined[self.gns==qgene]
+        a = self.gnnm.getrow(i)
+        b = self.gnnm_refined.getrow(i)
 
-        i1 = self.gns[a.nonzero()[1]]
-        i2 = self.gns[b.nonzero()[1]]
-        d1 = a.data
-        d2 = b.data
-        a = pd.Series(index=i1,data=d1)
-        b = pd.Series(index=i2,data=d2)
-        return {"blast":a,"correlation":b}    
+        a = pd.Series(index=self.gns[a.indices], data=a.data)
+        b = pd.Series(index=self.gns[b.indices], data=b.data)
+        return {"blast":a,"correlation":b}
 
     def query_gene_pair(self,gene1,gene2):
         """ Get BLAST and correlation score for a pair of genes.
@@ -535,32 +602,12 @@ class SAMAP(object):
         the BLAST and correlation scores respectively for the queried
         gene pair.
         """
-        ids = self.ids
-        qgene1 = None
-        if (gene1 in self.gns):
-            qgene1 = gene1
-        else:
-            for sid in ids:
-                if sid+'_'+gene1 in self.gns:
-                    qgene1 = sid+'_'+gene1
-                    break
-        if qgene1 is None:
-            raise ValueError(f"Query gene {gene1} not found in dataset.")
+        qgene1, i1 = self._resolve_gene(gene1)
+        qgene2, i2 = self._resolve_gene(gene2)
 
-        qgene2 = None
-        if (gene2 in self.gns):
-            qgene2 = gene2
-        else:
-            for sid in ids:
-                if sid+'_'+gene2 in self.gns:
-                    qgene2 = sid+'_'+gene2
-                    break
-        if qgene2 is None:
-            raise ValueError(f"Query gene {gene2} not found in dataset.")
-
-        a = self.gnnm[self.gns==qgene1].A.flatten()[self.gns==qgene2][0]
-        b = self.gnnm_refined[self.gns==qgene1].A.flatten()[self.gns==qgene2][0]
-        return {"blast":a,"correlation":b}  
+        a = self.gnnm[i1, i2]
+        b = self.gnnm_refined[i1, i2]
+        return {"blast":a,"correlation":b}
 
     def scatter(self,axes=None,COLORS=None,ss=None,**kwargs):  
         
@@ -572,11 +619,7 @@ class SAMAP(object):
         if COLORS is None:
             COLORS={}
             for sid in self.ids:
-                s = ''
-                for i in range(6):
-                    s+=hex(np.random.randint(16))[-1].upper()
-                s='#'+s                
-                COLORS[sid] = s
+                COLORS[sid] = "#{:06X}".format(np.random.randint(0, 0x1000000))
                 
         for sid in self.ids:            
             axes = self.sams[sid].scatter(projection = 'X_umap_samap', colorspec = COLORS[sid], axes = axes, s = ss[sid],colorbar=False,**kwargs)
@@ -605,16 +648,14 @@ class SAMAP(object):
         for sid in q(samap.adata.obs['species'])[np.sort(np.unique(samap.adata.obs['species'],return_index=True)[1])]:
             gns.extend(gns_dict[sid])
         gns=q(gns)
-        ix = pd.Series(data = np.arange(samap.adata.shape[1]),index = samap.adata.var_names)[gns].values
-        rixer = pd.Series(index =np.arange(gns.size), data = ix)         
-        x,y = gnnm.nonzero()
-        d = gnnm.data
-        gnnm = sp.sparse.coo_matrix((d,(rixer[x].values,rixer[y].values)),shape=(samap.adata.shape[1],)*2).tocsr()                           
+        ix = _positions(q(samap.adata.var_names), gns)
+        gco = gnnm.tocoo()
+        gnnm = sp.sparse.coo_matrix((gco.data,(ix[gco.row],ix[gco.col])),shape=(samap.adata.shape[1],)*2).tocsr()
         return gnnm
         
 class _Samap_Iter(object):
     def __init__(
-        self, sams, gnnm, gns_dict, keys=None
+        self, sams, gnnm, gns_dict, keys=None, track_history=False
     ):
         self.sams = sams
         self.gnnm = gnnm
@@ -637,7 +678,18 @@ class _Samap_Iter(object):
             self.GNNMS_corr,
             self.GNNMS_pruned,
         ]
+        self.track_history = track_history
         self.iter = 0
+        self._concat_cache = {}
+
+    def _record(self, lst, item):
+        # each per-iteration list holds only the most recent matrix unless
+        # history tracking is requested; keeping every iteration's sparse
+        # graphs alive inflates peak memory for the whole run.
+        if self.track_history or len(lst) == 0:
+            lst.append(item)
+        else:
+            lst[-1] = item
 
     def refine_homology_graph(self, NCLUSTERS=1, ncpus=os.cpu_count(), THR=0, corr_mode='pearson', wscale=False):
         if corr_mode=='mutual_info':
@@ -669,7 +721,7 @@ class _Samap_Iter(object):
 
     def run(self, NUMITERS=3, NHS=None, K=20, corr_mode='pearson', NCLUSTERS=1,
                   scale_edges_by_corr=True, THR=0, neigh_from_keys=None, pairwise=True,
-                  ncpus=os.cpu_count()):
+                  ncpus=os.cpu_count(), tol=None, backend="hnswlib"):
         sams = self.sams
         gnnm = self.gnnm
         gns_dict = self.gns_dict
@@ -694,11 +746,11 @@ class _Samap_Iter(object):
                 print("Calculating gene-gene correlations in the homology graph...")
                 gnnmu = self.refine_homology_graph(ncpus = ncpus, NCLUSTERS = NCLUSTERS, THR=THR, corr_mode=corr_mode)
 
-                self.GNNMS_corr.append(gnnmu)
+                self._record(self.GNNMS_corr, gnnmu)
                 self.gnnmu = gnnmu
 
             gnnm2 = _get_pairs(sams, gnnmu, gns_dict, NOPs1=0, NOPs2=0)
-            self.GNNMS_pruned.append(gnnm2)
+            self._record(self.GNNMS_pruned, gnnm2)
 
             sam4 = _mapper(
                 sams,
@@ -711,23 +763,41 @@ class _Samap_Iter(object):
                 keys=keys,
                 scale_edges_by_corr=scale_edges_by_corr,
                 neigh_from_keys=neigh_from_keys,
-                pairwise=pairwise
+                pairwise=pairwise,
+                concat_cache=self._concat_cache,
+                backend=backend
             )
             sam4.adata.uns['mapping_K'] = K
             self.samap = sam4
-            self.GNNMS_nnm.append(sam4.adata.obsp["connectivities"])
+            self._record(self.GNNMS_nnm, sam4.adata.obsp["connectivities"])
 
             print("Iteration " + str(i+1) + " complete.")
             print("Alignment scores:")
-            print(_avg_as(sam4))
+            AS = _avg_as(sam4)
+            print(AS)
 
             self.iter += 1
+            # refining the homology graph and rebuilding the map are the
+            # expensive steps; once the alignment scores stop moving there
+            # is nothing left to gain from further iterations.
+            if tol is not None:
+                delta = (
+                    np.abs(AS.values - self._prev_AS.values).max()
+                    if getattr(self, "_prev_AS", None) is not None
+                    else np.inf
+                )
+                self._prev_AS = AS
+                if delta < tol:
+                    print(
+                        "Alignment scores converged (delta={:.2e} < tol); stopping early.".format(delta)
+                    )
+                    break
             if i < NUMITERS - 1:
                 print("Calculating gene-gene correlations in the homology graph...")
                 self.samap = sam4
                 gnnmu = self.refine_homology_graph(ncpus = ncpus,  NCLUSTERS = NCLUSTERS,  THR=THR, corr_mode=corr_mode)
 
-                self.GNNMS_corr.append(gnnmu)
+                self._record(self.GNNMS_corr, gnnmu)
                 self.gnnmu = gnnmu
 
             gc.collect()
@@ -735,17 +805,34 @@ class _Samap_Iter(object):
         self.final_sam = sam4
 
 
+@njit(cache=True)
+def _avg_as_kernel(indptr, indices, data, codes, k):
+    # grouped sum straight off the CSR arrays; a serial loop keeps the
+    # shared k-by-k accumulator race-free and the pass is memory-bound
+    # anyway.
+    sums = np.zeros((k, k), dtype=np.float64)
+    for r in range(indptr.size - 1):
+        cr = codes[r]
+        for j in range(indptr[r], indptr[r + 1]):
+            sums[cr, codes[indices[j]]] += data[j]
+    return sums
+
+
 def _avg_as(s):
+    # one pass over the graph: bin every edge weight by its (row species,
+    # col species) pair instead of slicing a submatrix per species pair.
     x = q(s.adata.obs['species'])
     xu = np.unique(x)
-    a = np.zeros((xu.size,xu.size))
-    for i in range(xu.size):
-        for j in range(xu.size):
-            if i!=j:
-                a[i,j] = s.adata.obsp['connectivities'][x==xu[i],:][:,x==xu[j]].sum(1).A.flatten().mean() / s.adata.uns['mapping_K']
+    codes = np.searchsorted(xu, x)
+    conn = s.adata.obsp['connectivities'].tocsr()
+    k = xu.size
+    sums = _avg_as_kernel(conn.indptr, conn.indices, conn.data, codes, k)
+    counts = np.bincount(codes, minlength=k)
+    a = sums / counts[:, None] / s.adata.uns['mapping_K']
+    np.fill_diagonal(a, 0)
     return pd.DataFrame(data=a,index=xu,columns=xu)
         
-@njit(parallel=True)        
+@njit(parallel=True, cache=True)
 def _replace(X,xi,yi):
     data = np.zeros(xi.size)
     for i in prange(xi.size):
@@ -755,6 +842,47 @@ def _replace(X,xi,yi):
     return data
     
     
+def _get_csc_cache(sam):
+    """Return (and memoize) the CSC form of `sam.adata.X`.
+
+    The expression matrices are column-sliced by gene on every SAMap
+    iteration; converting CSR to CSC once and slicing the cached copy
+    avoids rebuilding the column index each time."""
+    X = sam.adata.X
+    cache = getattr(sam, "_X_csc_cache", None)
+    if cache is None or cache.shape != X.shape:
+        cache = X.tocsc()
+        sam._X_csc_cache = cache
+    return cache
+
+
+def _get_var_names(sam):
+    """Return (and memoize) `sam.adata.var_names` as an object array; the
+    per-species gene names never change after prefixing, but the pandas
+    Index -> array conversion was being repeated every iteration."""
+    cache = getattr(sam, "_var_names_cache", None)
+    if cache is None or cache.size != sam.adata.var_names.size:
+        cache = q(sam.adata.var_names)
+        sam._var_names_cache = cache
+    return cache
+
+
+def _get_species_rows(sam):
+    """Return (and memoize) per-species row indices of the stitched object.
+
+    The species column never changes between SAMap iterations, so the
+    boolean scans over the full cell axis only need to happen once."""
+    cache = getattr(sam, "_species_rows_cache", None)
+    if cache is None or cache[0] != sam.adata.shape[0]:
+        species = q(sam.adata.obs["species"])
+        rows = {}
+        for sid in np.unique(species):
+            rows[sid] = np.where(species == sid)[0].astype(np.int32)
+        cache = (sam.adata.shape[0], rows)
+        sam._species_rows_cache = cache
+    return cache[1]
+
+
 def _generate_coclustering_matrix(cl):
     cl = ut.convert_annotations(np.array(list(cl)))
     clu,cluc=np.unique(cl,return_counts=True)    
@@ -779,6 +907,8 @@ def _mapper(
     scale_edges_by_corr=False,
     neigh_from_keys=None,
     pairwise=True,
+    concat_cache=None,
+    backend="hnswlib",
     **kwargs
 ):
     if NHS is None:
@@ -792,7 +922,7 @@ def _mapper(
             neigh_from_keys[sid] = False    
     
     if mdata is None:
-        mdata = _mapping_window(sams, gnnm, gn, K=K, pairwise=pairwise)
+        mdata = _mapping_window(sams, gnnm, gn, K=K, pairwise=pairwise, backend=backend)
 
     k1 = K
 
@@ -824,8 +954,8 @@ def _mapper(
         species_indexer[i] += species_indexer[i-1].max()+1
     
     if not flag:
-        nnm_internal = sp.sparse.block_diag(list(nnms_in.values())).tocsr()
-    nnm_internal0 = sp.sparse.block_diag(list(nnms_in0.values())).tocsr()    
+        nnm_internal = _block_diag_csr(list(nnms_in.values()))
+    nnm_internal0 = _block_diag_csr(list(nnms_in0.values()))
     
     ovt = mdata["knn"]    
     ovt0 = ovt.copy()
@@ -854,15 +984,21 @@ def _mapper(
         del Cs
         gc.collect()
     else:
+        # materialize the transpose once; transposing inside the loop would
+        # rebuild it for every block.
+        nnm_internal_T = nnm_internal.T.tocsr()
+        # collect the blocks and stack once at the end - vstacking into the
+        # accumulator each iteration recopies all previous blocks' data.
+        Cs = []
         for bl in range(numiter):
-            print(str(bl) + "/" + str(numiter), D.shape)
-            C = B[bl * chunksize : (bl + 1) * chunksize].dot(nnm_internal.T)
+            print(str(bl) + "/" + str(numiter))
+            C = B[bl * chunksize : (bl + 1) * chunksize].dot(nnm_internal_T)
             C.data[C.data < 0.1] = 0
             C.eliminate_zeros()
-
-            D = sp.sparse.vstack((D, C))        
-            del C
-            gc.collect()
+            Cs.append(C)
+        D = sp.sparse.vstack(Cs, format="csr")
+        del Cs
+        gc.collect()
 
     D = D.multiply(D.T).tocsr()
     D.data[:] = D.data**0.5
@@ -879,25 +1015,25 @@ def _mapper(
         F.data[:] = vals
         
         # normalize by maximum and rescale with tanh
-        ma = F.max(1).A
+        ma = F.max(1).A.ravel()
         ma[ma==0]=1
-        F = F.multiply(1/ma).tocsr()
+        F = _scale_rows(F, 1/ma)
         F.data[:] = _tanh_scale(F.data,center=0.7,scale=10)
         
         # get max aligment score from before
-        ma = D.max(1).A
+        ma = D.max(1).A.ravel()
         ma[ma==0]=1
-        
+
         # geometric mean expression correlation scores by alignment scores
         D = F.multiply(D).tocsr()
         D.data[:] = np.sqrt(D.data)
-        
+
         # get new max scores
-        ma2 = D.max(1).A
+        ma2 = D.max(1).A.ravel()
         ma2[ma2==0]=1
-        
+
         # change new max scores to old max scores
-        D = D.multiply(ma/ma2).tocsr()
+        D = _scale_rows(D, ma/ma2)
     
     species_list = []
     for sid in sams.keys():
@@ -921,41 +1057,30 @@ def _mapper(
         Dk = sp.sparse.vstack(Dk).tocsr()
         denom = (k1 * (len(sams.keys())-1))
             
-    sr = Dk.sum(1).A    
-    
-    x = 1 - sr.flatten() / denom
-    
-    sr[sr==0]=1
-    st = Dk.sum(0).A.flatten()[None,:]
-    st[st==0]=1
-    proj = Dk.multiply(1 / sr).dot(Dk.multiply(1 / st)).tocsr()
-    z = proj.copy()
-    z.data[:] = 1
-    idx = np.where(z.sum(1).A.flatten() >= k1)[0]
-    
+    sr = Dk.sum(1).A1
+
+    x = 1 - sr / denom
+
+    # the projection-based edge reweighting that used to live here was a
+    # no-op: its LIL fancy-max update was overwritten by rebinding omp to
+    # nnm_internal0 right afterwards, so the SpMM feeding it (and the
+    # np.in1d masks) only burned time. The binarized within-species graph
+    # is all that is used downstream.
     omp = nnm_internal0
     omp.data[:]=1
-    s = proj.max(1).A
-    s[s == 0] = 1
-    proj = proj.multiply(1 / s).tocsr()    
-    X, Y = omp.nonzero()
-    X2 = X[np.in1d(X, idx)]
-    Y2 = Y[np.in1d(X, idx)]
-
-    omp = omp.tolil()
-    omp[X2, Y2] = np.vstack((proj[X2, Y2].A.flatten(), np.ones(X2.size) * 0.3)).max(
-        0
-    )
-
-    omp = nnm_internal0.tocsr()
     NNM = omp.multiply(x[:, None])
     NNM = (NNM+Dk).tolil()
     NNM.setdiag(0)
    
     print("Concatenating SAM objects...")
-    sam3 = _concatenate_sam(sams, NNM)
-    
-    sam3.adata.obs["species"] = pd.Categorical(species_list)
+    sam3 = _concatenate_sam(sams, NNM, cache=concat_cache)
+
+    if concat_cache is not None:
+        if "species_cat" not in concat_cache:
+            concat_cache["species_cat"] = pd.Categorical(species_list)
+        sam3.adata.obs["species"] = concat_cache["species_cat"]
+    else:
+        sam3.adata.obs["species"] = pd.Categorical(species_list)
 
     sam3.adata.uns["gnnm_corr"] = mdata.get("gnnm_corr",None)
 
@@ -964,6 +1089,75 @@ def _mapper(
         sc.tl.umap(sam3.adata, min_dist=0.1, maxiter = 500 if sam3.adata.shape[0] <= 10000 else 200)
     return sam3
 
+def _unique_undirected_pairs(r, c):
+    """Unique undirected (min, max) index pairs. Packing each edge into one
+    uint64 key turns the row-wise np.unique(..., axis=0) fallback into a
+    single 1-D sort."""
+    lo = np.minimum(r, c).astype(np.uint64)
+    hi = np.maximum(r, c).astype(np.uint64)
+    u = np.unique((lo << np.uint64(32)) | hi)
+    return np.stack(
+        ((u >> np.uint64(32)).astype(np.int64),
+         (u & np.uint64(0xFFFFFFFF)).astype(np.int64)),
+        axis=1,
+    )
+
+
+def _csc_submatrix(m_csc, idx):
+    """Extract m[idx, :][:, idx] from a CSC matrix in one vectorized pass
+    over the selected columns; `idx` must be sorted. Avoids the full
+    intermediate matrix a chained two-stage fancy-index slice creates."""
+    counts = np.diff(m_csc.indptr)[idx]
+    total = int(counts.sum())
+    cum = np.concatenate(([0], np.cumsum(counts)))
+    take = np.repeat(m_csc.indptr[idx] - cum[:-1], counts) + np.arange(total)
+    rows = m_csc.indices[take]
+    pos = np.searchsorted(idx, rows)
+    hit = idx[np.minimum(pos, idx.size - 1)] == rows
+    cols = np.repeat(np.arange(idx.size), counts)[hit]
+    indptr = np.zeros(idx.size + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(cols, minlength=idx.size))
+    return sp.sparse.csc_matrix(
+        (m_csc.data[take][hit], pos[hit], indptr), shape=(idx.size, idx.size)
+    )
+
+
+_REFINE_SHARED = None
+_LEIDEN_CACHE = {}
+
+
+def _refine_corr_sub_worker(sub):
+    sams, st, kwargs = _REFINE_SHARED
+    gnnm_sub, gns_dict_sub = sub
+    return _refine_corr_parallel(sams, st, gnnm_sub, gns_dict_sub, **kwargs)
+
+
+def _refine_corr_subs(sams, st, subs, kwargs):
+    """Refine each cluster sub-block; the blocks are independent, so with
+    NCLUSTERS > 1 they run in a forked process pool. The SAM objects are
+    shared with the workers through fork-inherited module state rather
+    than pickled per task."""
+    if len(subs) > 1 and os.name == "posix":
+        import concurrent.futures
+        import multiprocessing
+
+        global _REFINE_SHARED
+        _REFINE_SHARED = (sams, st, kwargs)
+        try:
+            ctx = multiprocessing.get_context("fork")
+            workers = min(len(subs), kwargs.get("ncpus") or os.cpu_count())
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=ctx
+            ) as ex:
+                return list(ex.map(_refine_corr_sub_worker, subs))
+        finally:
+            _REFINE_SHARED = None
+    return [
+        _refine_corr_parallel(sams, st, gnnm_sub, gns_dict_sub, **kwargs)
+        for gnnm_sub, gns_dict_sub in subs
+    ]
+
+
 def _refine_corr(
     sams,
     st,
@@ -980,76 +1174,115 @@ def _refine_corr(
     # import networkx as nx
     gns = np.concatenate(list(gns_dict.values()))
 
-    x, y = gnnm.nonzero()
-    sam = list(sams.values())[0]
-    cl = sam.leiden_clustering(gnnm, res=0.5)
-    ix = np.argsort(cl)
-    NGPC = gns.size // NCLUSTERS + 1
-
-    ixs = []
-    for i in range(NCLUSTERS):
-        ixs.append(np.sort(ix[i * NGPC : (i + 1) * NGPC]))
+    if NCLUSTERS > 1:
+        # the homology graph is re-refined on the same gnnm every outer
+        # iteration, so the partition is memoized on its sparsity pattern.
+        g = gnnm.tocsr()
+        key = (g.shape, hash(g.indptr.tobytes()), hash(g.indices.tobytes()))
+        cl = _LEIDEN_CACHE.get(key)
+        if cl is None:
+            sam = list(sams.values())[0]
+            cl = sam.leiden_clustering(gnnm, res=0.5)
+            if len(_LEIDEN_CACHE) > 8:
+                _LEIDEN_CACHE.clear()
+            _LEIDEN_CACHE[key] = cl
+        # stable order keeps the partition deterministic; array_split yields
+        # balanced blocks with no empty trailing chunk.
+        ix = np.argsort(cl, kind="stable")
+        ixs = [np.sort(c) for c in np.array_split(ix, NCLUSTERS)]
+    else:
+        # with a single cluster the partition is never used - skip the
+        # Leiden run and the sort entirely.
+        ixs = [np.arange(gns.size)]
 
     assert np.concatenate(ixs).size == gns.size
 
-    GNNMSUBS = []
-    GNSUBS = []
+    gnnm_csr = gnnm.tocsr()
+    gnnm_csc = gnnm.tocsc()
+    gnnm_csc.sort_indices()
+    subs = []
     for i in range(len(ixs)):
-        ixs[i] = np.unique(np.append(ixs[i], gnnm[ixs[i], :].nonzero()[1]))
-        gnnm_sub = gnnm[ixs[i], :][:, ixs[i]]
-        gnsub = gns[ixs[i]]
+        # neighbors of the row set come straight out of the CSR indices;
+        # no submatrix is sliced just to read its column coordinates.
+        counts = np.diff(gnnm_csr.indptr)[ixs[i]]
+        cum = np.concatenate(([0], np.cumsum(counts)))
+        take = np.repeat(gnnm_csr.indptr[ixs[i]] - cum[:-1], counts) + np.arange(
+            int(counts.sum())
+        )
+        ixs[i] = np.union1d(ixs[i], gnnm_csr.indices[take])
+        gnnm_sub = _csc_submatrix(gnnm_csc, ixs[i])
+        # each species occupies a contiguous range of the concatenated gns
+        # array, so the per-species membership test is a pure integer range
+        # check - no string-array np.in1d.
         gns_dict_sub={}
+        off = 0
         for sid in gns_dict.keys():
-            gn = gns_dict[sid]
-            gns_dict_sub[sid] = gn[np.in1d(gn,gnsub)]
+            lo, hi = off, off + gns_dict[sid].size
+            gns_dict_sub[sid] = gns[ixs[i][(ixs[i] >= lo) & (ixs[i] < hi)]]
+            off = hi
+        subs.append((gnnm_sub, gns_dict_sub))
+
+    kwargs = dict(
+        corr_mode=corr_mode,
+        THR=THR,
+        use_seq=use_seq,
+        T1=T1,
+        ncpus=ncpus,
+        wscale=wscale,
+    )
+    GNNMSUBS = _refine_corr_subs(sams, st, subs, kwargs)
+    gc.collect()
+
 
-        gnnm2_sub = _refine_corr_parallel(
-            sams,
-            st,
-            gnnm_sub,
-            gns_dict_sub,
-            corr_mode=corr_mode,
-            THR=THR,
-            use_seq=use_seq,
-            T1=T1,
-            ncpus=ncpus,
-            wscale=wscale
-        )
-        GNNMSUBS.append(gnnm2_sub)
-        GNSUBS.append(gnsub)
-        gc.collect()
-    
     I = []
-    P = []
     for i in range(len(GNNMSUBS)):
-        I.append(
-            np.unique(np.sort(np.vstack((GNNMSUBS[i].nonzero())).T, axis=1), axis=0)
-        )
-        P.append(GNSUBS[i][I[-1]])
+        I.append(_unique_undirected_pairs(*GNNMSUBS[i].nonzero()))
 
-    GNS = pd.DataFrame(data=np.arange(gns.size)[None, :], columns=gns)
-    gnnm3 = sp.sparse.lil_matrix(gnnm.shape)
+    # ixs[i] already maps sub-block rows to global gene indices, so the
+    # name round-trip through a pandas column lookup is unnecessary.
+    rows, cols, vals = [], [], []
     for i in range(len(I)):
-        x, y = GNS[P[i][:, 0]].values.flatten(), GNS[P[i][:, 1]].values.flatten()
-        gnnm3[x, y] = GNNMSUBS[i][I[i][:, 0], I[i][:, 1]].A.flatten()
-
-    gnnm3 = gnnm3.tocsr()
-    x, y = gnnm3.nonzero()
-    # gnnm3[y,x]=gnnm3.data
-    gnnm3 = gnnm3.tolil()
-    gnnm3[y, x] = gnnm3[x, y].A.flatten()
-    gnnm3 = gnnm3.tocsr()
+        rows.append(ixs[i][I[i][:, 0]])
+        cols.append(ixs[i][I[i][:, 1]])
+        vals.append(GNNMSUBS[i][I[i][:, 0], I[i][:, 1]].A.flatten())
+
+    gnnm3 = _scatter_csr(
+        np.concatenate(rows),
+        np.concatenate(cols),
+        np.concatenate(vals),
+        gnnm.shape,
+    )
+    # only the upper triangle is populated (pairs are sorted), so mirroring
+    # is a CSR-native maximum with the transpose - no LIL round-trip.
+    gnnm3 = gnnm3.maximum(gnnm3.T.tocsr())
     return gnnm3
 
 def _prepend_blast_prefix(data, pre):
-    x = [str(x).split("_")[0] for x in data]
-    vn = []
-    for i,g in enumerate(data):
-        if x[i] != pre:
-            vn.append(pre+"_"+g)
-        else:
-            vn.append(g)
-    return np.array(vn).astype('str').astype('object')
+    vn = q(data).astype("str")
+    prefixes = np.char.partition(vn, "_")[:, 0]
+    vn = vn.astype("object")
+    mask = prefixes != pre
+    vn[mask] = pre + "_" + vn[mask]
+    return vn
+
+def _read_blast_table(fn):
+    """Read a tab-delimited BLAST output table.
+
+    Uses the multithreaded pyarrow CSV reader when available - BLAST maps
+    are often multi-GB - and falls back to the default C engine otherwise."""
+    # only the query/target ids, e-value and bitscore columns are consumed
+    # downstream, so the other eight outfmt-6 columns are never parsed.
+    kwargs = dict(sep="\t", header=None, index_col=0, usecols=[0, 1, 10, 11])
+    try:
+        return pd.read_csv(fn, engine="pyarrow", **kwargs)
+    except (ImportError, ValueError):
+        pass
+    try:
+        return pd.read_csv(fn, **kwargs)
+    except ValueError:
+        # nonstandard column layout - parse everything as before.
+        return pd.read_csv(fn, sep="\t", header=None, index_col=0)
+
 
 def _calculate_blast_graph(ids, f_maps="maps/", eval_thr=1e-6, reciprocate=False):
     gns = []
@@ -1075,8 +1308,8 @@ def _calculate_blast_graph(ids, f_maps="maps/", eval_thr=1e-6, reciprocate=False
                         )
                     )
 
-                A = pd.read_csv(fA, sep="\t", header=None, index_col=0)
-                B = pd.read_csv(fB, sep="\t", header=None, index_col=0)
+                A = _read_blast_table(fA)
+                B = _read_blast_table(fB)
 
                 A.columns = A.columns.astype("<U100")
                 B.columns = B.columns.astype("<U100")
@@ -1103,26 +1336,28 @@ def _calculate_blast_graph(ids, f_maps="maps/", eval_thr=1e-6, reciprocate=False
                 gn1 = np.unique(np.append(inB2, inA))
                 gn2 = np.unique(np.append(inA2, inB))
                 gn = np.append(gn1, gn2)
-                gnind = pd.DataFrame(data=np.arange(gn.size)[None, :], columns=gn)
-
-                A.index = pd.Index(gnind[A.index].values.flatten())
-                B.index = pd.Index(gnind[B.index].values.flatten())
-                A[A.columns[0]] = gnind[A.iloc[:, 0].values.flatten()].values.flatten()
-                B[B.columns[0]] = gnind[B.iloc[:, 0].values.flatten()].values.flatten()
+                A.index = pd.Index(_positions(gn, q(A.index)))
+                B.index = pd.Index(_positions(gn, q(B.index)))
+                A[A.columns[0]] = _positions(gn, q(A.iloc[:, 0]))
+                B[B.columns[0]] = _positions(gn, q(B.iloc[:, 0]))
 
                 Arows = np.vstack((A.index, A.iloc[:, 0], A.iloc[:, i3])).T
                 Arows = Arows[A.iloc[:, i1].values.flatten() <= eval_thr, :]
-                gnnm1 = sp.sparse.lil_matrix((gn.size,) * 2)
-                gnnm1[Arows[:, 0].astype("int32"), Arows[:, 1].astype("int32")] = Arows[
-                    :, 2
-                ]  # -np.log10(Arows[:,2]+1e-200)
+                gnnm1 = _scatter_csr(
+                    Arows[:, 0].astype("int32"),
+                    Arows[:, 1].astype("int32"),
+                    Arows[:, 2].astype("float64"),
+                    (gn.size,) * 2,
+                )  # -np.log10(Arows[:,2]+1e-200)
 
                 Brows = np.vstack((B.index, B.iloc[:, 0], B.iloc[:, i3])).T
                 Brows = Brows[B.iloc[:, i1].values.flatten() <= eval_thr, :]
-                gnnm2 = sp.sparse.lil_matrix((gn.size,) * 2)
-                gnnm2[Brows[:, 0].astype("int32"), Brows[:, 1].astype("int32")] = Brows[
-                    :, 2
-                ]  # -np.log10(Brows[:,2]+1e-200)
+                gnnm2 = _scatter_csr(
+                    Brows[:, 0].astype("int32"),
+                    Brows[:, 1].astype("int32"),
+                    Brows[:, 2].astype("float64"),
+                    (gn.size,) * 2,
+                )  # -np.log10(Brows[:,2]+1e-200)
 
                 gnnm = (gnnm1 + gnnm2).tocsr()
                 gnnms = (gnnm + gnnm.T) / 2
@@ -1139,13 +1374,15 @@ def _calculate_blast_graph(ids, f_maps="maps/", eval_thr=1e-6, reciprocate=False
                 
                 V = gnnm.data
                 X,Y = gnnm.nonzero()
-                
-                Xs.extend(gn[X])
-                Ys.extend(gn[Y])
-                Vs.extend(V)
-                gns.extend(gn)
-    
-    gns = np.unique(gns)
+
+                # collect whole arrays; extending with the elements would
+                # box every gene name and score as a Python object.
+                Xs.append(gn[X])
+                Ys.append(gn[Y])
+                Vs.append(V)
+                gns.append(gn)
+
+    gns = np.unique(np.concatenate(gns)) if len(gns) > 0 else np.array([], dtype="object")
     gns_sp = np.array([x.split('_')[0] for x in gns])
     gns2 = []
     gns_dict={}
@@ -1153,10 +1390,11 @@ def _calculate_blast_graph(ids, f_maps="maps/", eval_thr=1e-6, reciprocate=False
         gns2.append(gns[gns_sp==sid])
         gns_dict[sid] = gns2[-1]
     gns = np.concatenate(gns2)
-    indexer = pd.Series(index=gns,data=np.arange(gns.size))
-    
-    X = indexer[Xs].values
-    Y = indexer[Ys].values
+    Xs = np.concatenate(Xs) if len(Xs) > 0 else np.array([], dtype="object")
+    Ys = np.concatenate(Ys) if len(Ys) > 0 else np.array([], dtype="object")
+    Vs = np.concatenate(Vs) if len(Vs) > 0 else np.array([], dtype="float64")
+    X = _positions(gns, Xs)
+    Y = _positions(gns, Ys)
     gnnm = sp.sparse.coo_matrix((Vs,(X,Y)),shape=(gns.size,gns.size)).tocsr()
     
     return gnnm, gns, gns_dict
@@ -1185,40 +1423,33 @@ def _coarsen_blast_graph(gnnm, gns, names):
     ss = pd.concat(ss)
     ss = ss[np.unique(q(ss.index),return_index=True)[1]]
     x,y = gnnm.nonzero() #get nonzeros
-    s = pd.Series(data=gns,index=np.arange(gns.size)) # convert indices to gene pairs
-    xn,yn = s[x].values,s[y].values 
-    xg,yg = ss[xn].values,ss[yn].values #convert gene pairs to translated
+    # translate once per gene, then gather per edge; looking the edge
+    # endpoints up through the Series hashed every name per nonzero.
+    tr = ss[gns].values
+    xg,yg = tr[x],tr[y] #convert gene pairs to translated
 
     da=gnnm.data
 
-    zgu,ix,ivx,cu = np.unique(np.array([xg,yg]).astype('str'),axis=1,return_counts=True,return_index=True,return_inverse=True) # find unique pairs
-
-    xgu,ygu = zgu[:,cu>1] # extract pairs that appear duplicated times
-    xgyg=q(xg.astype('object')+';'+yg.astype('object'))
-    xguygu=q(xgu.astype('object')+';'+ygu.astype('object'))
-
-    filt = np.in1d(xgyg,xguygu)
-
-    DF=pd.DataFrame(data=xgyg[filt][:,None],columns=['key'])
-    DF['val']=da[filt]
-
-    dic = df_to_dict(DF,key_key='key')
-
-    xgu = q([x.split(';')[0] for x in dic.keys()])
-    ygu = q([x.split(';')[1] for x in dic.keys()])
-    replz = q([max(dic[x]) for x in dic.keys()])
-
-    xgu1,ygu1 = zgu[:,cu==1] # get non-duplicate pairs
-    xg = np.append(xgu1, xgu) # append duplicate pairs
-    yg = np.append(ygu1, ygu)
-    da = np.append(da[ix][cu==1],replz) # append duplicate scores to the non-duplicate scores
+    # coalesce duplicate translated pairs by max score. Factorizing the
+    # names once and packing each pair into a single uint64 key turns the
+    # string-keyed dedup (joins, splits and a dict of lists) into one sort
+    # plus a run-length max.
+    codes, uniq_names = pd.factorize(np.concatenate((xg, yg)))
+    ga, gb = codes[: xg.size], codes[xg.size :]
+    key = (ga.astype(np.uint64) << np.uint64(32)) | gb.astype(np.uint64)
+    order = np.argsort(key, kind="stable")
+    ks = key[order]
+    starts = np.append(0, np.nonzero(np.diff(ks))[0] + 1)
+    da = np.maximum.reduceat(da[order], starts)
+    ukey = ks[starts]
+    xg = uniq_names[(ukey >> np.uint64(32)).astype(np.int64)]
+    yg = uniq_names[(ukey & np.uint64(0xFFFFFFFF)).astype(np.int64)]
     gn = np.unique(np.append(xg,yg)) # get the unique genes
 
-    s = pd.Series(data=np.arange(gn.size),index=gn) # create an indexer
-    xn,yn = s[xg].values,s[yg].values # convert gene pairs to indexes
+    xn,yn = _positions(gn, xg), _positions(gn, yg) # convert gene pairs to indexes
     gnnm = sp.sparse.coo_matrix((da,(xn,yn)),shape=(gn.size,)*2).tocsr() # create sparse matrix
 
-    f = gnnm.sum(1).A.flatten() != 0 #eliminate zero rows/columns
+    f = gnnm.sum(1).A1 != 0 #eliminate zero rows/columns
     gn = gn[f]
     sps = np.array([x.split('_')[0] for x in gn])
 
@@ -1244,6 +1475,23 @@ def prepare_SAMap_loadings(sam, npcs=300):
     ra = sam.adata.uns["run_args"]
     preprocessing = ra.get("preprocessing", "StandardScaler")
     weight_PCs = ra.get("weight_PCs", False)
+
+    # recomputing the sparse-PCA decomposition is the whole cost of this
+    # function; skip it when the loadings for these inputs already exist.
+    key = (npcs, preprocessing, weight_PCs, sam.adata.shape,
+           getattr(sam.adata.X, "nnz", None))
+    if (
+        getattr(sam, "_samap_loadings_key", None) == key
+        and "PCs_SAMap" in sam.adata.varm.keys()
+    ):
+        return
+
+    # the sparse PCA below is memory-bandwidth bound; fp32 expression
+    # halves the bytes moved per matvec and is ample precision here.
+    X = sam.adata.X
+    if sp.sparse.issparse(X) and X.dtype == np.float64:
+        sam.adata.X = X.astype(np.float32)
+
     A, _ = sam.calculate_nnm(
         n_genes=sam.adata.shape[1],
         preprocessing=preprocessing,
@@ -1254,25 +1502,65 @@ def prepare_SAMap_loadings(sam, npcs=300):
         weight_mode='dispersion'
     )
     sam.adata.varm["PCs_SAMap"] = A
+    sam._samap_loadings_key = key
+
+
+def _block_diag_csr(mats):
+    """Block-diagonal concatenation straight from the CSR member arrays.
+    sp.sparse.block_diag assembles through COO, re-sorting every input;
+    for CSR blocks the result is just shifted indptr/indices concats."""
+    mats = [m.tocsr() for m in mats]
+    n_rows = sum(m.shape[0] for m in mats)
+    n_cols = sum(m.shape[1] for m in mats)
+    idx_dtype = np.int32 if n_cols < np.iinfo(np.int32).max else np.int64
+    indptr = np.empty(n_rows + 1, dtype=np.int64)
+    indptr[0] = 0
+    indices = []
+    data = []
+    nnz = 0
+    col_off = 0
+    row_pos = 1
+    for m in mats:
+        indptr[row_pos : row_pos + m.shape[0]] = m.indptr[1:].astype(np.int64) + nnz
+        indices.append(m.indices.astype(idx_dtype) + idx_dtype(col_off))
+        data.append(m.data)
+        nnz += int(m.indptr[-1])
+        col_off += m.shape[1]
+        row_pos += m.shape[0]
+    return sp.sparse.csr_matrix(
+        (np.concatenate(data), np.concatenate(indices), indptr),
+        shape=(n_rows, n_cols),
+    )
 
 
-def _concatenate_sam(sams, nnm):
-    acns = []
-    exps = []
-    agns = []
-    sps = []
-    for i,sid in enumerate(sams.keys()):
-        acns.append(q(sams[sid].adata.obs_names))
-        sps.append([sid]*acns[-1].size)
-        exps.append(sams[sid].adata.X)
-        agns.append(q(sams[sid].adata.var_names))
+def _concatenate_sam(sams, nnm, cache=None):
+    # `cache` holds the iteration-invariant pieces (the block-diagonal
+    # expression matrix, the concatenated names and the merged obs frame);
+    # only the connectivity graph changes between SAMap iterations, so the
+    # expensive concatenation work is done once per run.
+    if cache is not None and "xx" in cache:
+        xx, agn, acn = cache["xx"], cache["agn"], cache["acn"]
+        sps = None
+    else:
+        acns = []
+        exps = []
+        agns = []
+        sps = []
+        for i,sid in enumerate(sams.keys()):
+            acns.append(q(sams[sid].adata.obs_names))
+            sps.append([sid]*acns[-1].size)
+            exps.append(sams[sid].adata.X)
+            agns.append(_get_var_names(sams[sid]))
 
 
-    acn = np.concatenate(acns)
-    agn = np.concatenate(agns)
-    sps = np.concatenate(sps)
+        acn = np.concatenate(acns)
+        agn = np.concatenate(agns)
+        sps = np.concatenate(sps)
 
-    xx = sp.sparse.block_diag(exps,format='csr')
+        xx = _block_diag_csr(exps)
+
+        if cache is not None:
+            cache["xx"], cache["agn"], cache["acn"] = xx, agn, acn
 
 
     sam = SAM(counts=(xx, agn, acn))
@@ -1287,12 +1575,30 @@ def _concatenate_sam(sams, nnm):
         "use_rep": "X",
         "metric": "euclidean",
     }
+    obs = cache.get("obs") if cache is not None else None
+    if obs is not None:
+        for k in obs.columns:
+            sam.adata.obs[k] = obs[k].values
+        sam.adata.var.columns = sam.adata.var.columns.astype("str")
+        return sam
+
+    # expand each species' categoricals through integer codes; building an
+    # object-string array per column allocated N Python strings each time.
+    N = sam.adata.shape[0]
     for i in sams.keys():
+        mask = sps == i
         for k in sams[i].adata.obs.keys():
-            if sams[i].adata.obs[k].dtype.name == "category":
-                z = np.array(['unassigned']*sam.adata.shape[0],dtype='object')
-                z[sps==i] = q(sams[i].adata.obs[k])
-                sam.adata.obs[i+'_'+k] = pd.Categorical(z)
+            col = sams[i].adata.obs[k]
+            if col.dtype.name == "category":
+                cats = list(col.cat.categories)
+                if "unassigned" in cats:
+                    una = cats.index("unassigned")
+                else:
+                    una = len(cats)
+                    cats = cats + ["unassigned"]
+                codes = np.full(N, una, dtype=np.int32)
+                codes[mask] = col.cat.codes.values.astype(np.int32)
+                sam.adata.obs[i+'_'+k] = pd.Categorical.from_codes(codes, cats)
 
     a = []
     for i,sid in enumerate(sams.keys()):
@@ -1303,9 +1609,36 @@ def _concatenate_sam(sams, nnm):
 
     for i in sam.adata.obs:
         sam.adata.obs[i] = sam.adata.obs[i].astype("str")
-        
+
+    if cache is not None:
+        cache["obs"] = sam.adata.obs.copy()
+
     return sam
 
+def _isin_hash(values, test):
+    """Hash-set membership test; skips the sort `np.in1d` performs per call.
+    `test` may be an array or a prebuilt (frozen)set to amortize set-up."""
+    if not isinstance(test, (set, frozenset)):
+        test = frozenset(test.tolist())
+    return np.fromiter((v in test for v in values), dtype=bool, count=len(values))
+
+
+def _positions(reference, queries):
+    """Positions of `queries` in `reference` via a sorted-array lookup;
+    avoids building a hash index (pandas DataFrame/Series) per call."""
+    order = np.argsort(reference)
+    return order[np.searchsorted(reference, queries, sorter=order)]
+
+
+def _scatter_csr(rows, cols, vals, shape):
+    # CSR equivalent of LIL fancy assignment: for duplicate (row, col)
+    # entries the last value written wins (COO construction would sum them).
+    key = rows.astype(np.int64) * shape[1] + cols.astype(np.int64)
+    _, ix = np.unique(key[::-1], return_index=True)
+    ix = key.size - 1 - ix
+    return sp.sparse.csr_matrix((vals[ix], (rows[ix], cols[ix])), shape=shape)
+
+
 def _map_features_un(A, B, sam1, sam2, thr=1e-6):
     i1 = np.where(A.columns == "10")[0][0]
     i3 = np.where(A.columns == "11")[0][0]
@@ -1316,41 +1649,47 @@ def _map_features_un(A, B, sam1, sam2, thr=1e-6):
     gn1 = q(sam1.adata.var_names)
     gn2 = q(sam2.adata.var_names)
 
-    gn1 = gn1[np.in1d(gn1, inA)]
-    gn2 = gn2[np.in1d(gn2, inB)]
+    gn1 = gn1[_isin_hash(gn1, inA)]
+    gn2 = gn2[_isin_hash(gn2, inB)]
+
+    gn1_set = frozenset(gn1.tolist())
+    gn2_set = frozenset(gn2.tolist())
 
-    A = A.iloc[np.in1d(inA, gn1), :]
-    B = B.iloc[np.in1d(inB, gn2), :]
+    A = A.iloc[_isin_hash(inA, gn1_set), :]
+    B = B.iloc[_isin_hash(inB, gn2_set), :]
 
     inA2 = q(A.iloc[:, 0])
     inB2 = q(B.iloc[:, 0])
 
-    A = A.iloc[np.in1d(inA2, gn2), :]
-    B = B.iloc[np.in1d(inB2, gn1), :]
+    A = A.iloc[_isin_hash(inA2, gn2_set), :]
+    B = B.iloc[_isin_hash(inB2, gn1_set), :]
 
     gn = np.append(gn1, gn2)
-    gnind = pd.DataFrame(data=np.arange(gn.size)[None, :], columns=gn)
 
-    A.index = pd.Index(gnind[A.index].values.flatten())
-    B.index = pd.Index(gnind[B.index].values.flatten())
-    A.iloc[:, 0] = gnind[A.iloc[:, 0].values.flatten()].values.flatten()
-    B.iloc[:, 0] = gnind[B.iloc[:, 0].values.flatten()].values.flatten()
+    A.index = pd.Index(_positions(gn, q(A.index)))
+    B.index = pd.Index(_positions(gn, q(B.index)))
+    A.iloc[:, 0] = _positions(gn, q(A.iloc[:, 0]))
+    B.iloc[:, 0] = _positions(gn, q(B.iloc[:, 0]))
 
     Arows = np.vstack((A.index, A.iloc[:, 0], A.iloc[:, i3])).T
     Arows = Arows[A.iloc[:, i1].values.flatten() <= thr, :]
-    gnnm1 = sp.sparse.lil_matrix((gn.size,) * 2)
-    gnnm1[Arows[:, 0].astype("int32"), Arows[:, 1].astype("int32")] = Arows[
-        :, 2
-    ]  # -np.log10(Arows[:,2]+1e-200)
+    gnnm1 = _scatter_csr(
+        Arows[:, 0].astype("int32"),
+        Arows[:, 1].astype("int32"),
+        Arows[:, 2].astype("float64"),
+        (gn.size,) * 2,
+    )  # -np.log10(Arows[:,2]+1e-200)
 
     Brows = np.vstack((B.index, B.iloc[:, 0], B.iloc[:, i3])).T
     Brows = Brows[B.iloc[:, i1].values.flatten() <= thr, :]
-    gnnm2 = sp.sparse.lil_matrix((gn.size,) * 2)
-    gnnm2[Brows[:, 0].astype("int32"), Brows[:, 1].astype("int32")] = Brows[
-        :, 2
-    ]  # -np.log10(Brows[:,2]+1e-200)
-
-    gnnm = (gnnm1 + gnnm2).tocsr()
+    gnnm2 = _scatter_csr(
+        Brows[:, 0].astype("int32"),
+        Brows[:, 1].astype("int32"),
+        Brows[:, 2].astype("float64"),
+        (gn.size,) * 2,
+    )  # -np.log10(Brows[:,2]+1e-200)
+
+    gnnm = gnnm1 + gnnm2
     gnnms = (gnnm + gnnm.T) / 2
     gnnm.data[:] = 1
     gnnms = gnnms.multiply(gnnm).multiply(gnnm.T).tocsr()
@@ -1358,132 +1697,150 @@ def _map_features_un(A, B, sam1, sam2, thr=1e-6):
 
 
 def _filter_gnnm(gnnm, thr=0.25):
-    x, y = gnnm.nonzero()
-    mas = gnnm.max(1).A.flatten()
-    gnnm4 = gnnm.copy()
-    gnnm4.data[gnnm4[x, y].A.flatten() < mas[x] * thr] = 0
+    gnnm4 = gnnm.tocsr(copy=True)
+    mas = gnnm4.max(1).A.flatten()
+    # compare the stored values against their row maxima directly; the
+    # fancy gnnm4[x, y] gather densified a 1-by-nnz matrix just to read
+    # the data array back out.
+    rows = np.repeat(np.arange(gnnm4.shape[0]), np.diff(gnnm4.indptr))
+    gnnm4.data[gnnm4.data < mas[rows] * thr] = 0
     gnnm4.eliminate_zeros()
-    x, y = gnnm4.nonzero()
-    z = gnnm4.data
-    gnnm4 = gnnm4.tolil()
-    gnnm4[y, x] = z
-    gnnm4 = gnnm4.tocsr()
-    return gnnm4
+    # mirror surviving entries onto their transpose positions. The BLAST
+    # graph is value-symmetric (built as (G + G.T) / 2), so the element-wise
+    # maximum with the transpose reproduces the old transpose-wins write
+    # exactly while running in one C pass.
+    return gnnm4.maximum(gnnm4.T).tocsr()
 
 
 def _get_pairs(sams, gnnm, gns_dict, NOPs1=0, NOPs2=0):
     # gnnm = filter_gnnm(gnnm)
-    su = gnnm.max(1).A
+    su = gnnm.max(1).A.ravel()
     su[su == 0] = 1
-    gnnm = gnnm.multiply(1 / su).tocsr()
+    # copy first: _scale_rows works in place and the caller keeps its graph
+    gnnm = _scale_rows(gnnm.tocsr(copy=True), 1 / su)
     Ws = {}
     for sid in sams.keys():
         Ws[sid] = sams[sid].adata.var["weights"][gns_dict[sid]].values
     
     W = np.concatenate(list(Ws.values()))
-    W[W < 0.0] = 0
-    W[W > 0.0] = 1
 
-    B = gnnm.multiply(W[None, :]).multiply(W[:, None]).tocsr()
-    B.eliminate_zeros()
-
-    return B
-
-@njit
-def nb_unique1d(ar):
-    """
-    Find the unique elements of an array, ignoring shape.
-    """
-    ar = ar.flatten()
-
-    optional_indices = True
-
-    if optional_indices:
-        perm = ar.argsort(kind='mergesort')
-        aux = ar[perm]
-    else:
-        ar.sort()
-        aux = ar
-    mask = np.empty(aux.shape, dtype=np.bool_)
-    mask[:1] = True
-    if aux.shape[0] > 0 and aux.dtype.kind in "cfmM" and np.isnan(aux[-1]):
-        if aux.dtype.kind == "c":  # for complex all NaNs are considered equivalent
-            aux_firstnan = np.searchsorted(np.isnan(aux), True, side='left')
-        else:
-            aux_firstnan = np.searchsorted(aux, aux[-1], side='left')
-        mask[1:aux_firstnan] = (aux[1:aux_firstnan] != aux[:aux_firstnan - 1])
-        mask[aux_firstnan] = True
-        mask[aux_firstnan + 1:] = False
-    else:
-        mask[1:] = aux[1:] != aux[:-1]
-
-
-    imask = np.cumsum(mask) - 1
-    inv_idx = np.empty(mask.shape, dtype=np.intp)
-    inv_idx[perm] = imask
-    idx = np.append(np.nonzero(mask)[0],mask.size)
+    # W is a 0/1 mask after thresholding, so the two broadcast multiplies
+    # (each allocating a fresh matrix) reduce to zeroing edges whose row
+    # or column gene is masked out.
+    rows = np.repeat(np.arange(gnnm.shape[0]), np.diff(gnnm.indptr))
+    drop = (W[rows] <= 0.0) | (W[gnnm.indices] <= 0.0)
+    gnnm.data[drop] = 0
+    gnnm.eliminate_zeros()
 
-                     #idx      #inverse   #counts
-    return aux[mask],perm[mask],inv_idx,np.diff(idx)
+    return gnnm
 
-@njit
+@njit(cache=True)
 def _xicorr(X,Y):
     '''xi correlation coefficient'''
     n = X.size
     xi = np.argsort(X,kind='quicksort')
     Y = Y[xi]
-    _,_,b,c = nb_unique1d(Y)
-    r = np.cumsum(c)[b]
-    _,_,b,c = nb_unique1d(-Y)
-    l = np.cumsum(c)[b]
+    # both rank vectors fall out of a single sort of Y: a run of ties
+    # [i, j] has r = j+1 values <= it and l = n-i values >= it. The two
+    # full unique() passes (and the -Y copy) used to recompute this.
+    order = np.argsort(Y, kind='mergesort')
+    r = np.empty(n, dtype=np.float64)
+    l = np.empty(n, dtype=np.float64)
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and Y[order[j + 1]] == Y[order[j]]:
+            j += 1
+        for t in range(i, j + 1):
+            r[order[t]] = j + 1
+            l[order[t]] = n - i
+        i = j + 1
     denominator = (2*(l*(n-l)).sum())
     if denominator > 0:
         return 1 - n*np.abs(np.diff(r)).sum() / denominator
     else:
         return 0
 
-@njit(parallel=True)
-def _refine_corr_kernel(p, ps, sids, sixs, indptr,indices,data, n, corr_mode):
-    p1 = p[:,0]
-    p2 = p[:,1]
-
-    ps1 = ps[:,0]
-    ps2 = ps[:,1]
-
-    d = {}
-    for i in range(len(sids)):
-        d[sids[i]] = sixs[i]
-    
-    res = np.zeros(p1.size)
-
-    for j in prange(len(p1)):
-        j1, j2 = p1[j], p2[j]
-        pl1d = data[indptr[j1] : indptr[j1 + 1]]
-        pl1i = indices[indptr[j1] : indptr[j1 + 1]]
-
-        sc1d = data[indptr[j2] : indptr[j2 + 1]]
-        sc1i = indices[indptr[j2] : indptr[j2 + 1]]
+@njit(cache=True, inline="always")
+def _gather_sorted(idx, vals, ix, out, off):
+    # two-pointer gather of a sparse column restricted to the sorted row
+    # subset `ix`; absent rows read as zero. Replaces scattering the whole
+    # column into a dense length-n buffer per pair.
+    b = 0
+    for a in range(ix.size):
+        target = ix[a]
+        while b < idx.size and idx[b] < target:
+            b += 1
+        if b < idx.size and idx[b] == target:
+            out[off + a] = vals[b]
+        else:
+            out[off + a] = 0.0
 
-        x = np.zeros(n)
-        x[pl1i] = pl1d
-        y = np.zeros(n)
-        y[sc1i] = sc1d
 
-        a1, a2 = ps1[j], ps2[j]
-        ix1 = d[a1]
-        ix2 = d[a2]
-        
+@njit(parallel=True, cache=True)
+def _refine_corr_kernel(p, psc, sixs, indptr,indices,data, n, corr_mode):
+    p1 = p[:,0]
+    p2 = p[:,1]
 
-        xa,xb,ya,yb = x[ix1],x[ix2],y[ix1],y[ix2]
-        xx=np.append(xa,xb)
-        yy=np.append(ya,yb)
-        
-        if corr_mode == "pearson":
-            c = ((xx-xx.mean())*(yy-yy.mean()) / xx.std() / yy.std()).sum() / xx.size
-        else:
-            c = _xicorr(xx,yy)
-        res[j] = c
-    return res  
+    ps1 = psc[:,0]
+    ps2 = psc[:,1]
+
+    mmax = 0
+    for i in range(len(sixs)):
+        if sixs[i].size > mmax:
+            mmax = sixs[i].size
+
+    # fp32 output: correlations are well within range and downstream keeps
+    # them at half width anyway. The running sums stay fp64 for accuracy.
+    res = np.zeros(p1.size, dtype=np.float32)
+
+    # distribute pairs over a prange of threads with strided inner loops
+    # so each thread allocates its working vectors once instead of twice
+    # per pair; prange cannot hoist allocations out of its body.
+    nt = get_num_threads()
+    for t in prange(nt):
+        xx = np.empty(2 * mmax)
+        yy = np.empty(2 * mmax)
+        for j in range(t, p1.size, nt):
+            j1, j2 = p1[j], p2[j]
+            pl1d = data[indptr[j1] : indptr[j1 + 1]]
+            pl1i = indices[indptr[j1] : indptr[j1 + 1]]
+
+            sc1d = data[indptr[j2] : indptr[j2 + 1]]
+            sc1i = indices[indptr[j2] : indptr[j2 + 1]]
+
+            ix1 = sixs[ps1[j]]
+            ix2 = sixs[ps2[j]]
+
+            m = ix1.size + ix2.size
+            _gather_sorted(pl1i, pl1d, ix1, xx, 0)
+            _gather_sorted(pl1i, pl1d, ix2, xx, ix1.size)
+            _gather_sorted(sc1i, sc1d, ix1, yy, 0)
+            _gather_sorted(sc1i, sc1d, ix2, yy, ix1.size)
+
+            if corr_mode == "pearson":
+                # closed-form Pearson from running sums accumulated in one
+                # fused pass; five separate reductions each re-read the
+                # pair's working vectors.
+                sx = 0.0
+                sy = 0.0
+                sxx = 0.0
+                syy = 0.0
+                sxy = 0.0
+                for t2 in range(m):
+                    xv = xx[t2]
+                    yv = yy[t2]
+                    sx += xv
+                    sy += yv
+                    sxx += xv * xv
+                    syy += yv * yv
+                    sxy += xv * yv
+                den = np.sqrt((sxx - sx * sx / m) * (syy - sy * sy / m))
+                c = (sxy - sx * sy / m) / den if den > 0 else 0.0
+            else:
+                c = _xicorr(xx[:m], yy[:m])
+            res[j] = c
+    return res
 
 def _refine_corr_parallel(
     sams,
@@ -1519,27 +1876,38 @@ def _refine_corr_parallel(
     for sid in gns_dict.keys():
         gns_dictO[sid] = gnO[ix==sid]
 
-    gnnmO = gnnm[w > 0, :][:, w > 0]
-    x, y = gnnmO.nonzero()
+    idxO = np.where(w > 0)[0]
+    gnnm_csc = gnnm.tocsc()
+    gnnm_csc.sort_indices()
+    gnnmO = _csc_submatrix(gnnm_csc, idxO).tocsr()
+    gnnmO.eliminate_zeros()
+    # edges come straight from the CSR structure; nonzero() would build a
+    # COO copy just to hand back the same coordinates.
+    x = np.repeat(np.arange(gnnmO.shape[0]), np.diff(gnnmO.indptr))
+    y = gnnmO.indices
 
-    pairs = np.unique(np.sort(np.vstack((x, y)).T, axis=1), axis=0)
+    pairs = _unique_undirected_pairs(x, y)
 
     xs, ys = q([i.split('_')[0] for i in gnO[pairs[:,0]]]), q([i.split('_')[0] for i in gnO[pairs[:,1]]])    
     pairs_species = np.vstack((xs,ys)).T
 
+    # keep everything in float32: scipy's sparse matmul has no fp16 kernel,
+    # so float16 inputs would silently upcast to fp64 inside the SpMM.
     nnm = st.adata.obsp["connectivities"]
     xs = []
     nnms = []
     for i,sid in enumerate(sams.keys()):
-        nnms.append(nnm[:,st.adata.obs['batch'] == f'batch{i+1}'])
-        s1 = nnms[-1].sum(1).A
+        nnms.append(nnm[:,st.adata.obs['batch'] == f'batch{i+1}'].tocsr())
+        s1 = nnms[-1].sum(1).A1
         s1[s1 < 1e-3] = 1
-        s1 = s1.flatten()[:, None]  
-        nnms[-1] = nnms[-1].multiply(1 / s1)
+        nnms[-1] = _scale_rows(
+            nnms[-1].astype(np.float32), (1 / s1).astype(np.float32)
+        )
 
-        xs.append(sams[sid].adata[:,gns_dictO[sid]].X.astype("float16"))
+        cols = _positions(_get_var_names(sams[sid]), gns_dictO[sid])
+        xs.append(_get_csc_cache(sams[sid])[:, cols].astype(np.float32))
 
-    Xs = sp.sparse.block_diag(xs).tocsc()
+    Xs = _block_diag_csr(xs).tocsc()
     nnms = sp.sparse.hstack(nnms).tocsr()
     Xavg = nnms.dot(Xs).tocsc()
 
@@ -1547,47 +1915,54 @@ def _refine_corr_parallel(
     p = pairs
     ps = pairs_species
 
-    gnnm2 = gnnm.multiply(w[:, None]).multiply(w[None, :]).tocsr()
-    x, y = gnnm2.nonzero()
-    pairs = np.unique(np.sort(np.vstack((x, y)).T, axis=1), axis=0)
+    species_rows = _get_species_rows(st)
+    sidss = np.unique(list(species_rows.keys()))
+    sixs = [species_rows[sid] for sid in sidss]
 
-    species = q(st.adata.obs['species'])
-    sixs = []
-    sidss = np.unique(species)
-    for sid in sidss:
-        sixs.append(np.where(species==sid)[0])
-    
-    vals = _refine_corr_kernel(p,ps,sidss,sixs,Xavg.indptr,Xavg.indices,Xavg.data,Xavg.shape[0], corr_mode)
+    if corr_mode == "pearson":
+        vals = _batched_pearson(Xavg, p, ps, species_rows)
+    else:
+        # small integer codes instead of string keys: the kernel indexes
+        # the reflected list directly, with no typed-dict hash per pair.
+        psc = np.searchsorted(sidss, ps.astype(sidss.dtype))
+        vals = _refine_corr_kernel(p,psc,sixs,Xavg.indptr,Xavg.indices,Xavg.data,Xavg.shape[0], corr_mode)
     vals[np.isnan(vals)]=0
 
-    CORR = dict(zip(to_vn(np.vstack((gnO[p[:,0]],gnO[p[:,1]])).T),vals))
-
-    for k in CORR.keys():
-        CORR[k] = 0 if CORR[k] < THR else CORR[k]
-        if wscale:
-            id1,id2 = [x.split('_')[0] for x in k.split(';')]
-            weight1 = sams[id1].adata.var["weights"][k.split(';')[0]]
-            weight2 = sams[id2].adata.var["weights"][k.split(';')[1]]
-            CORR[k] = np.sqrt(CORR[k] * np.sqrt(weight1 * weight2))   
-
-    CORR = np.array([CORR[x] for x in to_vn(gn[pairs])])    
-
-    gnnm3 = sp.sparse.lil_matrix(gnnm.shape)
-
+    vals[vals < THR] = 0
+    if wscale:
+        wser = pd.concat([sams[sid].adata.var["weights"] for sid in sams.keys()])
+        w1 = wser[gnO[p[:, 0]]].values
+        w2 = wser[gnO[p[:, 1]]].values
+        vals = np.sqrt(vals * np.sqrt(w1 * w2))
+
+    # map the filtered-gene pair indices back to the full gene ordering.
+    # the compressed indices preserve order, so the correlations line up
+    # with the pairs directly and no keyed realignment is needed.
+    pairs = idxO[p]
+    CORR = vals
+
+    # assemble both edge directions as triplets in one CSR construction;
+    # LIL fancy assignment wrote every entry through a Python-level loop.
     if use_seq:
-        gnnm3[pairs[:, 0], pairs[:, 1]] = (
-            CORR * gnnm2[pairs[:, 0], pairs[:, 1]].A.flatten()
-        )
-        gnnm3[pairs[:, 1], pairs[:, 0]] = (
-            CORR * gnnm2[pairs[:, 1], pairs[:, 0]].A.flatten()
-        )
+        gnnm2 = gnnm.multiply(w[:, None]).multiply(w[None, :]).tocsr()
+        fwd = CORR * gnnm2[pairs[:, 0], pairs[:, 1]].A.flatten()
+        bwd = CORR * gnnm2[pairs[:, 1], pairs[:, 0]].A.flatten()
     else:
-        gnnm3[pairs[:, 0], pairs[:, 1]] = CORR  # *gnnm2[x,y].A.flatten()
-        gnnm3[pairs[:, 1], pairs[:, 0]] = CORR  # *gnnm2[x,y].A.flatten()
-
-    gnnm3 = gnnm3.tocsr()
+        fwd = bwd = CORR
+
+    m = pairs[:, 0] != pairs[:, 1]
+    gnnm3 = sp.sparse.csr_matrix(
+        (
+            np.concatenate((fwd, bwd[m])),
+            (
+                np.concatenate((pairs[:, 0], pairs[m, 1])),
+                np.concatenate((pairs[:, 1], pairs[m, 0])),
+            ),
+        ),
+        shape=gnnm.shape,
+    )
     gnnm3.eliminate_zeros()
-    return gnnm3 
+    return gnnm3
 
 try:
     from fast_histogram import histogram2d
@@ -1634,64 +2009,126 @@ def calc_MI(X,Y,bins=100,cl=None,cs=None):
     else:
         return MI / np.sqrt(H_X*H_Y)
 
-def _parallel_wrapper(j):
-    j1, j2 = p[j, 0], p[j, 1]
-
-    pl1d = Xavg.data[Xavg.indptr[j1] : Xavg.indptr[j1 + 1]]
-    pl1i = Xavg.indices[Xavg.indptr[j1] : Xavg.indptr[j1 + 1]]
-
-    sc1d = Xavg.data[Xavg.indptr[j2] : Xavg.indptr[j2 + 1]]
-    sc1i = Xavg.indices[Xavg.indptr[j2] : Xavg.indptr[j2 + 1]]
-
-    x = np.zeros(Xavg.shape[0])
-    x[pl1i] = pl1d
-    y = np.zeros(Xavg.shape[0])
-    y[sc1i] = sc1d
-
-    ha = gnsO[j1] + ";" + gnsO[j2]
-
-    try:
-        if corr_mode == 'xicorr':
-            CORR[ha] = _xicorr(x,y)
-        elif corr_mode == 'mutual_info':
-            CORR[ha] = calc_MI(x,y,cl=cl,cs=cs)
+def _batched_pearson(Xavg, p, ps, species_rows):
+    """Pearson correlations for all gene pairs at once via sparse column
+    dot-products, restricted per pair to the cells of the two species
+    involved. Avoids materializing a dense cell-length vector per pair."""
+    vals = np.zeros(p.shape[0], dtype=np.float32)
+    combos = np.unique(ps.astype("str"), axis=0)
+    Xcsr = Xavg.tocsr()
+    for a1, a2 in combos:
+        f = np.logical_and(ps[:, 0] == a1, ps[:, 1] == a2)
+        if a1 == a2:
+            ix = species_rows[a1]
+        else:
+            ix = np.sort(np.concatenate((species_rows[a1], species_rows[a2])))
+        X = Xcsr[ix].tocsc()
+        n = ix.size
+        # per-column moments are computed once and gathered per pair, so
+        # each gene is standardized a single time per species combo.
+        mu = X.sum(0).A1 / n
+        var = X.multiply(X).sum(0).A1 / n - mu ** 2
+        mu1, mu2 = mu[p[f, 0]], mu[p[f, 1]]
+        sd = np.sqrt(var[p[f, 0]] * var[p[f, 1]])
+        num = X[:, p[f, 0]].multiply(X[:, p[f, 1]]).sum(0).A1 / n - mu1 * mu2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vals[f] = num / sd
+    return vals
+
+
+class _FaissIndex(object):
+    """Exact nearest-neighbor index backed by FAISS (GPU when available),
+    exposing hnswlib's `knn_query` interface so the distance
+    post-processing in `_united_proj` stays backend-agnostic."""
+
+    def __init__(self, wpca, metric="cosine"):
+        try:
+            import faiss
+        except ImportError:
+            raise ImportError("Package `faiss` must be installed for `backend='faiss'`.")
+        x = np.ascontiguousarray(wpca, dtype=np.float32)
+        if metric == "cosine":
+            x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+            index = faiss.IndexFlatIP(x.shape[1])
         else:
-            raise ValueError(f'`{corr_mode}` not recognized.')
-    except:
-        CORR[ha] = 0
+            index = faiss.IndexFlatL2(x.shape[1])
+        if getattr(faiss, "get_num_gpus", lambda: 0)() > 0:
+            index = faiss.index_cpu_to_all_gpus(index)
+        index.add(x)
+        self._index = index
+        self._metric = metric
+
+    def knn_query(self, wpca, k=20, num_threads=None):
+        x = np.ascontiguousarray(wpca, dtype=np.float32)
+        if self._metric == "cosine":
+            x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        D, I = self._index.search(x, k)
+        if self._metric == "cosine":
+            # FAISS returns inner products; convert to hnswlib's
+            # cosine-distance convention.
+            D = 1 - D
+        return I, D
+
+
+def _build_hnsw_index(wpca, metric="cosine", ef=200, M=48, backend="hnswlib"):
+    metric = 'l2' if metric == 'euclidean' else metric
+    metric = 'cosine' if metric == 'correlation' else metric
+    if backend == "faiss":
+        return _FaissIndex(wpca, metric=metric)
+    labels = np.arange(wpca.shape[0])
+    p = hnswlib.Index(space=metric, dim=wpca.shape[1])
+    p.init_index(max_elements=wpca.shape[0], ef_construction=ef, M=M)
+    p.set_num_threads(os.cpu_count())
+    p.add_items(wpca, labels, num_threads=os.cpu_count())
+    p.set_ef(ef)
+    return p
 
 
-def _united_proj(wpca1, wpca2, k=20, metric="cosine", ef=200, M=48):
+def _united_proj(wpca1, wpca2, k=20, metric="cosine", ef=200, M=48, index=None, backend="hnswlib"):
 
     metric = 'l2' if metric == 'euclidean' else metric
     metric = 'cosine' if metric == 'correlation' else metric
-    labels2 = np.arange(wpca2.shape[0])
-    p2 = hnswlib.Index(space=metric, dim=wpca2.shape[1])
-    p2.init_index(max_elements=wpca2.shape[0], ef_construction=ef, M=M)
-    p2.add_items(wpca2, labels2)
-    p2.set_ef(ef)
-    idx1, dist1 = p2.knn_query(wpca1, k=k)
+    p2 = _build_hnsw_index(wpca2, metric=metric, ef=ef, M=M, backend=backend) if index is None else index
+    idx1, dist1 = p2.knn_query(wpca1, k=k, num_threads=os.cpu_count())
 
     if metric == 'cosine':
         dist1 = 1 - dist1
-        dist1[dist1 < 1e-3] = 1e-3
+        np.maximum(dist1, 1e-3, out=dist1)
         dist1 = dist1/dist1.max(1)[:,None]
         dist1 = _tanh_scale(dist1,scale=10, center=0.7)
     else:
         sigma1 = dist1[:,4]
         sigma1[sigma1<1e-3]=1e-3
         dist1 = np.exp(-dist1/sigma1[:,None])
-        
+
     Sim1 = dist1  # np.exp(-1*(1-dist1)**2)
-    knn1v2 = sp.sparse.lil_matrix((wpca1.shape[0], wpca2.shape[0]))
-    x1 = np.tile(np.arange(idx1.shape[0])[:, None], (1, idx1.shape[1])).flatten()
-    knn1v2[x1.astype('int32'), idx1.flatten().astype('int32')] = Sim1.flatten()
-    return knn1v2.tocsr()
+    # the kNN output has exactly k entries per row in row-major order,
+    # so the CSR arrays can be materialized directly without LIL assembly.
+    indptr = np.arange(0, (idx1.shape[0] + 1) * k, k, dtype=np.int64)
+    indices = idx1.astype(np.int32).ravel()
+    data = Sim1.astype(np.float32).ravel()
+    knn1v2 = sp.sparse.csr_matrix(
+        (data, indices, indptr), shape=(wpca1.shape[0], wpca2.shape[0])
+    )
+    return knn1v2
 
 def _tanh_scale(x,scale=10,center=0.5):
     return center + (1-center) * np.tanh(scale * (x - center))
 
-def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
+def _scale_rows(X, scale):
+    """Scale each row of a CSR matrix in place; one pass over the data array
+    instead of the copy allocated by X.multiply(scale[:, None])."""
+    X = X.tocsr()
+    X.data *= np.repeat(scale, np.diff(X.indptr))
+    return X
+
+def _scale_cols(X, scale):
+    """Scale each column of a sparse matrix in place via its CSC data array."""
+    X = X.tocsc()
+    X.data *= np.repeat(scale, np.diff(X.indptr))
+    return X.tocsr()
+
+def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True, ef=200, M=48, backend="hnswlib"):
     k = K
     output_dict = {}
     if gnnm is not None and gns is not None:
@@ -1709,10 +2146,12 @@ def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
         species_indexer = []   
         genes_indexer = [] 
         for sid in sams.keys():
-            gs[sid] = gns[np.in1d(gns,q(sams[sid].adata.var_names))]
+            gs[sid] = gns[_isin_hash(gns, _get_var_names(sams[sid]))]
             adatas[sid] = sams[sid].adata[:,gs[sid]]
             Ws[sid] = adatas[sid].var["weights"].values
-            ss[sid] = std.fit_transform(adatas[sid].X).multiply(Ws[sid][None,:]).tocsr()
+            cols = _positions(_get_var_names(sams[sid]), gs[sid])
+            Xg = _get_csc_cache(sams[sid])[:, cols]
+            ss[sid] = std.fit_transform(Xg).multiply(Ws[sid][None,:]).tocsr()
             species_indexer.append(np.arange(ss[sid].shape[0]))
             genes_indexer.append(np.arange(gs[sid].size))
 
@@ -1720,11 +2159,11 @@ def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
             species_indexer[i] = species_indexer[i]+species_indexer[i-1].max()+1
             genes_indexer[i] = genes_indexer[i]+genes_indexer[i-1].max()+1
 
-        su = gnnm_corr.sum(0).A
+        su = gnnm_corr.sum(0).A1
         su[su==0]=1
-        gnnm_corr = gnnm_corr.multiply(1/su).tocsr()
-        
-        X = sp.sparse.block_diag(list(ss.values())).tocsr()
+        gnnm_corr = _scale_cols(gnnm_corr, 1/su)
+
+        X = _block_diag_csr(list(ss.values()))
         W = np.concatenate(list(Ws.values())).flatten()
 
         ttt=time.time()
@@ -1733,13 +2172,22 @@ def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
             Xtr = []
             for i,sid1 in enumerate(sams.keys()):
                 xtr = []
+                # the (rows of species i) x (genes of species i) block of X
+                # is ss[sid1] itself; re-slicing it for every j cost two
+                # fancy CSR slices per species pair.
+                Xi = ss[sid1]
+                gi = slice(genes_indexer[i][0], genes_indexer[i][-1] + 1)
                 for j,sid2 in enumerate(sams.keys()):
                     if i != j:
-                        gnnm_corr_sub = gnnm_corr[genes_indexer[i]][:,genes_indexer[j]]
-                        su = gnnm_corr_sub.sum(0).A
+                        # the per-species gene blocks are contiguous, so
+                        # plain slices hit scipy's fast path instead of two
+                        # fancy-index extractions.
+                        gj = slice(genes_indexer[j][0], genes_indexer[j][-1] + 1)
+                        gnnm_corr_sub = gnnm_corr[gi, gj]
+                        su = gnnm_corr_sub.sum(0).A1
                         su[su==0]=1
-                        gnnm_corr_sub = gnnm_corr_sub.multiply(1/su).tocsr()                        
-                        xtr.append(X[species_indexer[i]][:,genes_indexer[i]].dot(gnnm_corr_sub))
+                        gnnm_corr_sub = _scale_cols(gnnm_corr_sub, 1/su)
+                        xtr.append(Xi.dot(gnnm_corr_sub))
                         xtr[-1] = std.fit_transform(xtr[-1]).multiply(W[genes_indexer[j]][None,:])
                     else:
                         xtr.append(sp.sparse.csr_matrix((species_indexer[i].size,genes_indexer[i].size)))
@@ -1750,21 +2198,25 @@ def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
 
             Xtr = []
             for i,sid in enumerate(sams.keys()):
-                Xtr.append(X[species_indexer[i]].dot(gnnm_corr))
+                # the row block of X for species i is ss[sid] with zeros
+                # outside its own gene range, so the product only sees the
+                # matching row stripe of the correlation matrix.
+                gi = slice(genes_indexer[i][0], genes_indexer[i][-1] + 1)
+                Xtr.append(ss[sid].dot(gnnm_corr[gi, :]))
                 Xtr[-1] = std.fit_transform(Xtr[-1]).multiply(W[None,:])
             Xtr = sp.sparse.vstack(Xtr)
         Xc = (X + Xtr).tocsr()
 
         mus = []        
         for i,sid in enumerate(sams.keys()):
-            mus.append(Xc[species_indexer[i]].mean(0).A.flatten())
+            mus.append(Xc[species_indexer[i]].mean(0).A1)
 
         gc.collect()   
         
         print('Projecting data into joint latent space.',time.time()-ttt) 
         C = sp.linalg.block_diag(*[adatas[sid].varm["PCs_SAMap"] for sid in sams.keys()])
-        M = np.vstack(mus).dot(C)    
-        ttt=time.time()    
+        MU = np.vstack(mus).dot(C)
+        ttt=time.time()
         it = 0;
         PCAs=[]
         for sid in sams.keys():
@@ -1775,8 +2227,8 @@ def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
         print('Correcting data with means.',time.time()-ttt)            
         for i,sid in enumerate(sams.keys()):
             ixq = species_indexer[i]
-            wpca[ixq] -= M[i]       
-        output_dict["gnnm_corr"] = gnnm_corr 
+            wpca[ixq] -= MU[i]
+        output_dict["gnnm_corr"] = gnnm_corr
     else:
         std = StandardScaler(with_mean=False)    
 
@@ -1790,44 +2242,45 @@ def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
         for sid in sams.keys():
             adatas[sid] = sams[sid].adata
             Ws[sid] = adatas[sid].var["weights"].values
-            ss[sid] = std.fit_transform(adatas[sid].X).multiply(Ws[sid][None,:]).tocsr()
-            mus.append(ss[sid].mean(0).A.flatten())
+            ss[sid] = std.fit_transform(_get_csc_cache(sams[sid])).multiply(Ws[sid][None,:]).tocsr()
+            mus.append(ss[sid].mean(0).A1)
             species_indexer.append(np.arange(ss[sid].shape[0]))        
         for i in range(1,len(species_indexer)):
             species_indexer[i] = species_indexer[i]+species_indexer[i-1].max()+1            
         X = sp.sparse.vstack(list(ss.values()))
         C = np.hstack([adatas[sid].varm["PCs_SAMap"] for sid in sams.keys()])
         wpca = X.dot(C)
-        M = np.vstack(mus).dot(C)         
+        MU = np.vstack(mus).dot(C)
         for i,sid in enumerate(sams.keys()):
             ixq = species_indexer[i]
-            wpca[ixq] -= M[i]            
+            wpca[ixq] -= MU[i]
         
     ixg = np.arange(wpca.shape[0])
     Xs = []
     Ys = []
     Vs = []
+    # each species' index is queried by every other species; build it once.
+    indexes = {}
     for i,sid in enumerate(sams.keys()):
         ixq = species_indexer[i]
-        query = wpca[ixq]          
-        
+        query = wpca[ixq]
+
         for j,sid2 in enumerate(sams.keys()):
             if i!=j:
                 ixr = species_indexer[j]
                 reference = wpca[ixr]
 
-                b = _united_proj(query, reference, k=k)
-                
+                if sid2 not in indexes:
+                    indexes[sid2] = _build_hnsw_index(reference, ef=ef, M=M, backend=backend)
+                b = _united_proj(query, reference, k=k, ef=ef, M=M, index=indexes[sid2])
+
                 # sum-normalize each species individually.
-                su = b.sum(1).A
+                su = b.sum(1).A1
                 su[su==0]=1
-                b = b.multiply(1/su).tocsr()
-
-                A = pd.Series(index = np.arange(b.shape[0]), data = ixq)        
-                B = pd.Series(index = np.arange(b.shape[1]), data = ixr)
+                b = _scale_rows(b, 1/su)
 
                 x,y = b.nonzero()
-                x,y = A[x].values,B[y].values
+                x,y = ixq[x], ixr[y]
                 Xs.extend(x)
                 Ys.extend(y)
                 Vs.extend(b.data)
@@ -1840,23 +2293,11 @@ def _mapping_window(sams, gnnm=None, gns=None, K=20, pairwise=True):
 
 
 def _sparse_knn_ks(D, ks):
-    D1 = D.tocoo()
-    idr = np.argsort(D1.row)
-    D1.row[:] = D1.row[idr]
-    D1.col[:] = D1.col[idr]
-    D1.data[:] = D1.data[idr]
-
-    row, ind = np.unique(D1.row, return_index=True)
-    ind = np.append(ind, D1.data.size)
-    for i in range(ind.size - 1):
-        idx = np.argsort(D1.data[ind[i] : ind[i + 1]])
-        k = ks[row[i]]
-        if idx.size > k:
-            if k != 0:
-                idx = idx[:-k]
-            else:
-                idx = idx
-            D1.data[np.arange(ind[i], ind[i + 1])[idx]] = 0
+    D1 = D.tocsr()
+    indptr, indices, data = _csr_topk_kernel(
+        D1.indptr.astype(np.int64), D1.indices, D1.data, ks.astype(np.int64)
+    )
+    D1 = sp.sparse.csr_matrix((data, indices, indptr), shape=D1.shape)
     D1.eliminate_zeros()
     return D1
 
@@ -1865,13 +2306,19 @@ def _smart_expand(nnm, cl, NH=3):
     stage0 = nnm.copy()
     S = [stage0]
     running = stage0
+    # binary pattern of all edges seen at earlier hops; masking against it
+    # replaces the per-hop LIL fancy-indexed zeroing.
+    seen = stage0.copy().tocsr()
+    seen.data[:] = 1
     for i in range(1, NH + 1):
         stage = running.dot(stage0)
         running = stage
-        stage = stage.tolil()
-        for j in range(i):
-            stage[S[j].nonzero()] = 0
-        stage = stage.tocsr()
+        stage = (stage - stage.multiply(seen)).tocsr()
+        stage.eliminate_zeros()
+        pattern = stage.copy()
+        pattern.data[:] = 1
+        seen = seen + pattern
+        seen.data[:] = 1
         S.append(stage)
 
     a, ix, c = np.unique(cl, return_counts=True, return_inverse=True)
@@ -1,4 +1,5 @@
 from . import np, ut, pd
+from numba import njit, prange
 
 def save_samap(sm,fn):
     import dill
@@ -125,19 +126,42 @@ def substr(x, s="_", ix=None, obj=False):
         return MS
 
 
+@njit(parallel=True, cache=True)
+def _csr_topk_kernel(indptr, indices, data, ks):
+    n = indptr.size - 1
+    counts = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        rowlen = indptr[i + 1] - indptr[i]
+        k = ks[i]
+        counts[i] = rowlen if rowlen < k else k
+    new_indptr = np.zeros(n + 1, dtype=np.int64)
+    new_indptr[1:] = np.cumsum(counts)
+    new_indices = np.empty(new_indptr[n], dtype=indices.dtype)
+    new_data = np.empty(new_indptr[n], dtype=data.dtype)
+    for i in prange(n):
+        s, e = indptr[i], indptr[i + 1]
+        k = counts[i]
+        o = new_indptr[i]
+        if e - s == k:
+            new_indices[o : o + k] = indices[s:e]
+            new_data[o : o + k] = data[s:e]
+        else:
+            order = np.argsort(data[s:e])
+            for j in range(k):
+                ix = order[e - s - 1 - j]
+                new_indices[o + j] = indices[s + ix]
+                new_data[o + j] = data[s + ix]
+    return new_indptr, new_indices, new_data
+
+
 def sparse_knn(D, k):
-    D1 = D.tocoo()
-    idr = np.argsort(D1.row)
-    D1.row[:] = D1.row[idr]
-    D1.col[:] = D1.col[idr]
-    D1.data[:] = D1.data[idr]
-
-    _, ind = np.unique(D1.row, return_index=True)
-    ind = np.append(ind, D1.data.size)
-    for i in range(ind.size - 1):
-        idx = np.argsort(D1.data[ind[i] : ind[i + 1]])
-        if idx.size > k:
-            idx = idx[:-k]
-            D1.data[np.arange(ind[i], ind[i + 1])[idx]] = 0
+    import scipy.sparse as ss
+
+    D1 = D.tocsr()
+    ks = np.full(D1.shape[0], k, dtype=np.int64)
+    indptr, indices, data = _csr_topk_kernel(
+        D1.indptr.astype(np.int64), D1.indices, D1.data, ks
+    )
+    D1 = ss.csr_matrix((data, indices, indptr), shape=D1.shape)
     D1.eliminate_zeros()
     return D1
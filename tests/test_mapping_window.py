@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+anndata = pytest.importorskip("anndata")
+pytest.importorskip("hnswlib")
+mapping = pytest.importorskip("samap.mapping")
+
+
+def _make_sam(sid, n_cells, genes, npcs, seed):
+    """Build a minimal SAM-like object with the fields _mapping_window reads."""
+    rng = np.random.RandomState(seed)
+    X = sp.random(n_cells, len(genes), density=0.5, random_state=rng, format="csr")
+    X.data = X.data.astype(np.float32)
+
+    class FakeSAM:
+        pass
+
+    sam = FakeSAM()
+    sam.adata = anndata.AnnData(
+        X=X.astype(np.float32),
+        var=pd.DataFrame({"weights": np.ones(len(genes))}, index=genes),
+    )
+    sam.adata.varm["PCs_SAMap"] = rng.rand(len(genes), npcs).astype(np.float32)
+    return sam
+
+
+def _make_sams(species_sizes, npcs=4):
+    sams = {}
+    gns = []
+    for seed, (sid, (n_cells, n_genes)) in enumerate(species_sizes.items()):
+        genes = np.array([f"{sid}_g{i}" for i in range(n_genes)])
+        sams[sid] = _make_sam(sid, n_cells, genes, npcs, seed)
+        gns.append(genes)
+    return sams, np.concatenate(gns)
+
+
+def _make_gnnm(species_sizes, seed=0):
+    """Symmetric cross-species gene graph over the concatenated gene list."""
+    rng = np.random.RandomState(seed)
+    sizes = [n_genes for (_, n_genes) in species_sizes.values()]
+    blocks = [[None] * len(sizes) for _ in range(len(sizes))]
+    for i, ni in enumerate(sizes):
+        for j, nj in enumerate(sizes):
+            if i < j:
+                B = sp.random(ni, nj, density=0.4, random_state=rng, format="csr")
+                blocks[i][j] = B
+                blocks[j][i] = B.T
+            elif i == j:
+                blocks[i][j] = sp.csr_matrix((ni, nj))
+    return sp.bmat(blocks, format="csr")
+
+
+def _check_knn(out, species_sizes, k):
+    sizes = [n_cells for (n_cells, _) in species_sizes.values()]
+    n_total = sum(sizes)
+    knn = out["knn"]
+    assert knn.shape == (n_total, n_total)
+    assert out["wPCA"].shape[0] == n_total
+    # each cell's neighbors live in the other species' blocks only.
+    offsets = np.cumsum([0] + sizes)
+    for i in range(len(sizes)):
+        block = knn[offsets[i]:offsets[i + 1], offsets[i]:offsets[i + 1]]
+        assert block.nnz == 0
+    rows_nnz = np.diff(knn.indptr)
+    assert rows_nnz.max() <= k * (len(sizes) - 1)
+    assert rows_nnz.min() > 0
+
+
+def test_mapping_window_no_gnnm_hnswlib():
+    # the no-gnnm branch assumes a shared feature space across species.
+    species_sizes = {"aa": (30, 15), "bb": (40, 15)}
+    sams, _ = _make_sams(species_sizes)
+    out = mapping._mapping_window(sams, K=5, backend="hnswlib")
+    _check_knn(out, species_sizes, k=5)
+
+
+def test_mapping_window_reuses_reference_indexes(monkeypatch):
+    # with three species every reference is queried twice; the per-reference
+    # cache must build each hnswlib index exactly once, passing the integer
+    # graph-degree M through to init_index.
+    species_sizes = {"aa": (20, 12), "bb": (25, 12), "cc": (30, 12)}
+    sams, _ = _make_sams(species_sizes)
+    calls = []
+    build = mapping._build_hnsw_index
+
+    def counting_build(wpca, **kwargs):
+        calls.append(kwargs["M"])
+        return build(wpca, **kwargs)
+
+    monkeypatch.setattr(mapping, "_build_hnsw_index", counting_build)
+    out = mapping._mapping_window(sams, K=5, backend="hnswlib")
+    _check_knn(out, species_sizes, k=5)
+    assert len(calls) == len(species_sizes)
+    assert all(isinstance(m, int) for m in calls)
+
+
+@pytest.mark.parametrize("pairwise", [True, False])
+def test_mapping_window_gnnm_hnswlib(pairwise):
+    species_sizes = {"aa": (30, 10), "bb": (40, 12)}
+    sams, gns = _make_sams(species_sizes)
+    gnnm = _make_gnnm(species_sizes)
+    out = mapping._mapping_window(
+        sams, gnnm=gnnm, gns=gns, K=5, pairwise=pairwise, backend="hnswlib"
+    )
+    _check_knn(out, species_sizes, k=5)
+    assert "gnnm_corr" in out